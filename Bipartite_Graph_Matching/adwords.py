@@ -1,308 +1,581 @@
 ## Author - Tushar Dahibhate
 ## Unity-Id - tdahibh
 
+import argparse
 import sys
+import multiprocessing
+import os
 import pandas as pd
+import numpy as np
 import math
-import random
-
-random.seed(0)
+import heapq
+import hashlib
+import json
+from scipy import sparse
+from scipy.optimize import linprog
+from types import MappingProxyType
 
 #------------------------------------------------------------------------------------
 
-class Advertiser:
-    """ This class represents the Advertiser
-            id - Id of the Advertiser
-            budget - Budget of the Advertiser
-            bids - Dictionary containing all the keywords and their respective bids
+class BidderIndex:
+    """ This class represents the immutable advertiser/keyword index of the bidder dataset
+            advertiser_budget - Read-only mapping of every Advertiser to its initial budget
+            advertiser_bids - Read-only mapping of every Advertiser to its keyword bids
+            query_neighbours - Read-only mapping of every keyword to the tuple of Advertisers bidding on it
     """
     
-    def __init__(self, id, budget, bids):
-        self.id = id        
-        self.budget = budget
-        self.bids = bids
+    def __init__(self, advertiser_budget, advertiser_bids, query_neighbours):
+        self.advertiser_budget = MappingProxyType(advertiser_budget)
+        self.advertiser_bids = MappingProxyType({advertiser: MappingProxyType(bids) 
+                                                 for advertiser, bids in advertiser_bids.items()})
+        self.query_neighbours = MappingProxyType(query_neighbours)
 
 #------------------------------------------------------------------------------------
 
-def process_data():    
-    """ This function processes the data """
+def process_data(path='bidder_dataset.csv'):    
+    """ This function processes the data once into a BidderIndex.
+        The budget of an Advertiser is taken from its first row, as in the dataset only that row carries it.
+    """
     
-    advertiser_budget = dict()
-    query_neighbours = dict()
-    advertisers = dict()
-
-    df = pd.read_csv('bidder_dataset.csv')
-
-    for index in range(0, df.shape[0]):
-                   
-        advertiser = int(df.iloc[index]['Advertiser'])
-
-        budget = float(df.iloc[index]['Budget'])
-
-        key_word = df.iloc[index]['Keyword']
-
-        bid_value = float(df.iloc[index]['Bid Value'])
-                        
-        if advertiser not in advertiser_budget:
-            advertiser_budget[advertiser] = budget
-        
-        if advertiser not in advertisers:
-            advertisers[advertiser] = Advertiser(advertiser, advertiser_budget[advertiser], {key_word: bid_value})
-        else:
-            advertisers[advertiser].bids[key_word] = bid_value
-                        
-        if key_word not in query_neighbours:
-            query_neighbours[key_word] = [advertiser]
-        else:
-            query_neighbours[key_word].append(advertiser) 
+    df = pd.read_csv(path)
+    df['Advertiser'] = df['Advertiser'].astype(int)
+    
+    first_rows = df.drop_duplicates('Advertiser')
+    advertiser_budget = dict(zip(first_rows['Advertiser'].tolist(), first_rows['Budget'].astype(float).tolist()))
+    
+    advertiser_bids = {advertiser: dict(zip(group['Keyword'].tolist(), group['Bid Value'].astype(float).tolist())) 
+                       for advertiser, group in df.groupby('Advertiser', sort=False)}
+    
+    query_neighbours = {key_word: tuple(neighbours) 
+                        for key_word, neighbours in df.groupby('Keyword', sort=False)['Advertiser'].agg(list).items()}
                     
-    return advertisers, advertiser_budget, query_neighbours
+    return BidderIndex(advertiser_budget, advertiser_bids, query_neighbours)
 
 #------------------------------------------------------------------------------------
 
-def get_queries():
+def stream_queries(f):
+    """ This function lazily yields the queries of an open file, one per line """
+    
+    for line in f:
+        yield line.strip()
+
+
+def get_queries(path='queries.txt'):
     """ This function returns a list of all the queries """
     
-    with open('queries.txt', 'r') as f:
-        queries = [line.strip() for line in f]
+    with open(path, 'r') as f:
+        queries = list(stream_queries(f))
     return queries
 
 #------------------------------------------------------------------------------------
 
-def greedy(queries, advertisers, advertiser_budget, query_neighbours):
-    """ This function implements the greedy algorithm in the documentation"""
+class AuctionEngine:
+    """ This class represents the array-backed auction engine built from a BidderIndex.
+        The bids are kept in a CSR (compressed sparse row) keyword -> advertiser layout.
+            keyword_ids - Mapping of every keyword to its integer id
+            advertiser_ids - Array of the Advertiser at every advertiser position
+            offsets - Row pointer; the bidders of keyword id k are at offsets[k]:offsets[k + 1]
+            neighbours - Advertiser position of every bid
+            bids - Value of every bid
+            initial_budget - Initial budget of every advertiser position
+            budget - Remaining budget of every advertiser position
+            budget_view, initial_budget_view - memoryviews of the two budget arrays for fast scalar access
+            rows - (position, bid) pairs of every keyword with fewer than VECTOR_DEGREE bidders, else None
+            indexed - Whether MSVV and Balance use per-keyword heaps for rows of at least HEAP_DEGREE bidders
+            heaps, heap_method - Lazily built heap of every keyword and the method they are keyed for
+    """
     
-    total_revenue = 0
+    # Below this many bidders a scalar scan beats the fixed cost of the NumPy calls
+    VECTOR_DEGREE = 32
     
-    for query in queries:
-        neighbours = query_neighbours[query]             
+    # From this many bidders on, the heap beats the scan. Every Balance win makes the top entry out of date,
+    # so Balance needs wider rows than MSVV, whose scan pays for a math.exp per bidder.
+    HEAP_DEGREE = {'msvv': 1, 'balance': 16}
+    
+    def __init__(self, index, indexed=True):
+        self.advertiser_ids = np.fromiter(index.advertiser_budget.keys(), dtype=np.int64)
+        position = {advertiser: i for i, advertiser in enumerate(index.advertiser_budget)}
+        
+        keywords = list(index.query_neighbours)
+        self.keyword_ids = {key_word: i for i, key_word in enumerate(keywords)}
+        
+        self.offsets = np.zeros(len(keywords) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum([len(index.query_neighbours[key_word]) for key_word in keywords])
+        
+        self.neighbours = np.fromiter((position[advertiser] 
+                                       for key_word in keywords for advertiser in index.query_neighbours[key_word]), 
+                                      dtype=np.int64, count=self.offsets[-1])
+        self.bids = np.fromiter((index.advertiser_bids[advertiser][key_word] 
+                                 for key_word in keywords for advertiser in index.query_neighbours[key_word]), 
+                                dtype=np.float64, count=self.offsets[-1])
+        
+        self.initial_budget = np.fromiter(index.advertiser_budget.values(), dtype=np.float64)
+        self.budget = self.initial_budget.copy()
+        
+        self.rows = []
+        for keyword_id in range(len(keywords)):
+            start, end = self.offsets[keyword_id], self.offsets[keyword_id + 1]
+            if end - start < self.VECTOR_DEGREE:
+                self.rows.append(tuple(zip(self.neighbours[start:end].tolist(), self.bids[start:end].tolist())))
+            else:
+                self.rows.append(None)
+                
+        self.indexed = indexed
+        self.heaps = [None] * len(keywords)
+        self.heap_method = None
                 
-        if has_sufficient_budget(advertisers, query, neighbours):             
-            max_bid = get_highest_bid_greedy(neighbours, advertisers, query)            
-            total_revenue += max_bid     
+        self.bind()
+        
+    def bind(self):
+        """ This function creates the memoryviews of the budgets and the table of scans """
+        
+        self.initial_budget_view = memoryview(self.initial_budget)
+        self.budget_view = memoryview(self.budget)
+        self.scans = {'greedy': self.scan_greedy, 'msvv': self.scan_msvv, 'balance': self.scan_balance}
+        
+    def __getstate__(self):
+        """ This function leaves out the memoryviews and bound scans, which cannot be pickled """
+        
+        state = self.__dict__.copy()
+        for name in ['initial_budget_view', 'budget_view', 'scans']:
+            del state[name]
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.bind()
+        
+    def reset(self):
+        """ This function restores the full budget of every Advertiser """
+        
+        self.budget[:] = self.initial_budget
+        self.heaps = [None] * len(self.rows)
+        
+    def padded_rows(self):
+        """ This function returns the bidder rows as dense keywords x max degree arrays of positions and bids,
+            plus one extra row for unknown keywords. Padding bids are infinite, so no budget can afford them.
+        """
+        
+        degrees = np.diff(self.offsets)
+        width = max(1, int(degrees.max(initial=0)))
+        
+        padded_neighbours = np.zeros((len(self.rows) + 1, width), dtype=np.int64)
+        padded_bids = np.full((len(self.rows) + 1, width), np.inf)
+        
+        rows = np.repeat(np.arange(len(self.rows)), degrees)
+        columns = np.arange(len(self.neighbours)) - np.repeat(self.offsets[:-1], degrees)
+        padded_neighbours[rows, columns] = self.neighbours
+        padded_bids[rows, columns] = self.bids
+        
+        return padded_neighbours, padded_bids
+        
+    def encode(self, queries):
+        """ This function returns the keyword ids of the queries, -1 for a keyword nobody bids on """
+        
+        return [self.keyword_ids.get(query, -1) for query in queries]
+        
+    def allocate(self, keyword_id, method):
+        """ This function allocates one query to the winning bidder, decrements the bid from its budget
+            and returns the bid as the revenue, 0 if no bidder can afford its bid
+        """
+        
+        if keyword_id < 0:
+            return 0.0
+        
+        row = self.rows[keyword_id]
+        
+        if self.indexed and method != 'greedy' and \
+                self.offsets[keyword_id + 1] - self.offsets[keyword_id] >= self.HEAP_DEGREE[method]:
+            winner, bid = self.scan_heap(keyword_id, method)
+        elif row is None:
+            winner, bid = self.scan_vectorized(keyword_id, method)
+        else:
+            winner, bid = self.scans[method](row)
             
-    return total_revenue
-
-
-def get_highest_bid_greedy(neighbours, advertisers, query):
-    """ This function returns the highest bid and decrements the bid from the advertiser's balance
-        for the greedy algorithm
-    """
+        if winner < 0:
+            return 0.0
+        
+        self.budget_view[winner] -= bid
+        
+        return bid
+    
+    # Every scan checks the budget and picks the winner in the same pass over the bidders.
+    # Ties go to the first bidder, as in the sequential scan of the documentation.
+    
+    def scan_greedy(self, row):
+        """ This function returns the affordable bidder with the highest bid """
+        
+        budget = self.budget_view
+        winner, max_bid = -1, -float("inf")
+        
+        for position, bid in row:
+            if bid > max_bid and bid <= budget[position]:
+                winner, max_bid = position, bid
+                
+        return winner, max_bid
+    
+    def scan_msvv(self, row):
+        """ This function returns the affordable bidder with the highest bid scaled by psi(X_u) """
+        
+        budget = self.budget_view
+        initial_budget = self.initial_budget_view
+        winner, max_bid, max_value = -1, 0.0, -float("inf")
+        
+        for position, bid in row:
+            remaining = budget[position]
+            if bid <= remaining:
+                X_u = (initial_budget[position] - remaining)/initial_budget[position]
+                value = (1 - math.exp(X_u - 1)) * bid
+                if value > max_value:
+                    winner, max_bid, max_value = position, bid, value
+                    
+        return winner, max_bid
+    
+    def scan_balance(self, row):
+        """ This function returns the affordable bidder with the highest remaining budget """
+        
+        budget = self.budget_view
+        winner, max_bid, max_budget = -1, 0.0, -float("inf")
+        
+        for position, bid in row:
+            remaining = budget[position]
+            if remaining > max_budget and bid <= remaining:
+                winner, max_bid, max_budget = position, bid, remaining
+                
+        return winner, max_bid
     
-    max_bid = 0
-    max_bidder = 0
+    def scan_vectorized(self, keyword_id, method):
+        """ This function does the scan of a keyword with many bidders as one masked argmax """
         
-    for neighbour in neighbours:        
-        bid = advertisers[neighbour].bids[query]        
-        if bid > max_bid and bid <= advertisers[neighbour].budget:
-            max_bid = bid
-            max_bidder = neighbour
+        start, end = self.offsets[keyword_id], self.offsets[keyword_id + 1]
+        neighbours = self.neighbours[start:end]
+        bids = self.bids[start:end]
+        remaining = self.budget[neighbours]
+        
+        if method == 'greedy':
+            score = bids
+        elif method == 'msvv':
+            initial = self.initial_budget[neighbours]
+            score = (1 - np.exp((initial - remaining)/initial - 1)) * bids
+        else:
+            score = remaining
             
-    advertisers[max_bidder].budget -= max_bid
+        score = np.where(bids <= remaining, score, -np.inf)
+        best = score.argmax()
+        
+        if score[best] == -np.inf:
+            return -1, 0.0
+        
+        return neighbours[best], float(bids[best])
+        
+    # The MSVV and Balance scores of a bidder only fall as budgets are spent. A heap entry therefore never
+    # scores below its bidder's current score, so an up-to-date entry at the top of the heap is the winner.
+    # Out-of-date entries are rescored when they reach the top, and bidders that cannot afford their bid
+    # are dropped for good. Only the top few entries are touched per query instead of every bidder.
     
-    return max_bid
-
-
-def process_cr_greedy():
-    """ This function will calculate the competitive ratio for Greedy approach"""
+    def heap_key(self, method, position, bid, remaining):
+        """ This function returns the heap key of a bidder, its negated MSVV or Balance score """
         
-    total_revenue = 0.0
-    avg_revenue = 0.0
+        if method == 'msvv':
+            X_u = (self.initial_budget_view[position] - remaining)/self.initial_budget_view[position]
+            return -((1 - math.exp(X_u - 1)) * bid)
+        
+        return -remaining
     
-    for x in range(0, 100):    
-
-        advertisers, advertiser_budget, query_neighbours = process_data() 
-        queries = get_queries()
-
-        random.shuffle(queries)
-
-        total_revenue += greedy(queries, advertisers, advertiser_budget, query_neighbours)        
+    def build_heap(self, keyword_id, method):
+        """ This function builds the heap of a keyword. Every entry is (key, order in the row, position,
+            bid, the remaining budget the key was computed from); the order breaks ties towards the first bidder.
+        """
+        
+        start, end = self.offsets[keyword_id], self.offsets[keyword_id + 1]
+        row = zip(self.neighbours[start:end].tolist(), self.bids[start:end].tolist())
+        budget = self.budget_view
         
-    avg_revenue = total_revenue/100    
-    competitive_ratio = avg_revenue/sum(advertiser_budget.values())
+        heap = [(self.heap_key(method, position, bid, budget[position]), order, position, bid, budget[position]) 
+                for order, (position, bid) in enumerate(row) if bid <= budget[position]]
+        heapq.heapify(heap)
+        
+        return heap
     
-    return competitive_ratio    
-
-
+    def scan_heap(self, keyword_id, method):
+        """ This function returns the winner of MSVV or Balance from the heap of the keyword """
+        
+        if method != self.heap_method:
+            self.heaps = [None] * len(self.rows)
+            self.heap_method = method
+            
+        heap = self.heaps[keyword_id]
+        if heap is None:
+            heap = self.heaps[keyword_id] = self.build_heap(keyword_id, method)
+            
+        budget = self.budget_view
+        
+        while heap:
+            key, order, position, bid, scored_budget = heap[0]
+            remaining = budget[position]
+            
+            if bid > remaining:
+                heapq.heappop(heap)
+            elif remaining != scored_budget:
+                heapq.heapreplace(heap, (self.heap_key(method, position, bid, remaining), order, position, bid, remaining))
+            else:
+                return position, bid
+            
+        return -1, 0.0
+        
 #------------------------------------------------------------------------------------
 
-def has_sufficient_budget(advertisers, query, neighbours):
-    """ This function checks if the neighbours have sufficient balance or not"""
+def allocate_queries(queries, engine, method):
+    """ This function allocates the keyword ids in the given order and returns the total revenue """
     
-    for neighbour in neighbours:        
-        bid_value = advertisers[neighbour].bids[query]
-        
-        if advertisers[neighbour].budget >= bid_value:
-            return True     
+    total_revenue = 0
+    
+    for keyword_id in queries:
+        total_revenue += engine.allocate(keyword_id, method)
         
-    return False    
+    return total_revenue
 
 #------------------------------------------------------------------------------------
 
-def msvv(queries, advertisers, advertiser_budget, query_neighbours):
-    """ This function implements the MSVV algorithm in the documentation"""
+def process_stream(engine, f, method, interval=10000):
+    """ This function allocates every query of the stream as it arrives and prints the running revenue
+        every interval queries, or never if interval is 0. Memory stays constant however long the stream is.
+        Returns the total revenue and the number of queries.
+    """
     
     total_revenue = 0
+    count = 0
     
-    for query in queries:
-        neighbours = query_neighbours[query]             
-                
-        if has_sufficient_budget(advertisers, query, neighbours):             
-            max_bid = get_highest_bid_msvv(neighbours, advertisers, query, advertiser_budget)            
-            total_revenue += max_bid     
+    for count, query in enumerate(stream_queries(f), 1):
+        total_revenue += engine.allocate(engine.keyword_ids.get(query, -1), method)
+        
+        if interval and count % interval == 0:
+            print("{} queries: {:0.2f}".format(count, total_revenue), flush=True)
             
-    return total_revenue
+    return total_revenue, count
+
+#------------------------------------------------------------------------------------
+
+def init_trial_worker(engine, queries, method):
+    """ This function stores the read-only inputs of the trials in a worker process """
+    
+    global trial_state
+    trial_state = (engine, queries, method)
 
 
-def compute_function_X_u(advertisers, advertiser_budget, neighbour):
-    """ This function calculates the function(X_u) given in the documentation"""
+def run_trial(seed):
+    """ This function allocates one shuffle of the queries, drawn from the given seed, and returns its revenue """
+    
+    engine, queries, method = trial_state
+    
+    trial_queries = shuffle_queries(queries, seed).tolist()
+    
+    engine.reset()
     
-    X_u = (advertiser_budget[neighbour] - advertisers[neighbour].budget)/advertiser_budget[neighbour]    
-    e = math.exp(X_u - 1)
+    return allocate_queries(trial_queries, engine, method)
+
+
+def process_cr(engine, queries, method, trials=100, workers=1, seed=0, optimum=None):
+    """ This function will calculate the competitive ratio of the given approach over shuffled trials,
+        against the offline optimum unless another optimum is given.
+        Every trial gets its own seed spawned from the given one, so the result does not depend on the
+        number of workers. Returns the mean competitive ratio and its 95% confidence interval.
+    """
     
-    return 1 - e
+    if workers == 1:
+        init_trial_worker(engine, queries, method)
+        revenues = [run_trial(trial_seed) for trial_seed in spawn_trial_seeds(seed, trials)]
+    else:
+        with multiprocessing.Pool(workers, initializer=init_trial_worker, initargs=(engine, queries, method)) as pool:
+            revenues = pool.map(run_trial, spawn_trial_seeds(seed, trials), chunksize=max(1, trials//(4*workers)))
+            
+    if optimum is None:
+        optimum = offline_optimum(engine, queries)
+        
+    return summarize_revenues(revenues, optimum)
 
 
-def get_highest_bid_msvv(neighbours, advertisers, query, advertiser_budget):
-    """ This function returns the highest bid and decrements the bid from the advertiser's balance 
-        for the msvv algorithm
+def process_cr_batched(engine, queries, method, trials=100, seed=0, optimum=None):
+    """ This function calculates the same competitive ratio as process_cr, but runs all the trials together.
+        The budgets of the trials are the rows of one trials x advertisers matrix, and every step allocates
+        the next query of every trial with one masked argmax over the padded bidder rows.
     """
     
-    max_bid = 0
-    max_bidder = 0
-    max_value = -float("inf")
+    permutations = np.stack([shuffle_queries(queries, trial_seed) for trial_seed in spawn_trial_seeds(seed, trials)])
+    
+    # Unknown keywords (-1) point at the extra all-padding row
+    permutations[permutations < 0] = len(engine.rows)
+    
+    padded_neighbours, padded_bids = engine.padded_rows()
+    width = padded_neighbours.shape[1]
+    initial_budget = engine.initial_budget
+    
+    # The budgets are addressed through the flat view: cell = trial * advertisers + position
+    budget = np.tile(initial_budget, (trials, 1))
+    flat_budget = budget.ravel()
+    trial_offsets = (np.arange(trials) * len(initial_budget))[:, None]
+    picks = np.arange(trials) * width
+    revenues = np.zeros(trials)
+    
+    for step in range(len(queries)):
+        keyword_ids = permutations[:, step]
+        neighbours = padded_neighbours[keyword_ids]
+        cells = neighbours + trial_offsets
+        bids = padded_bids[keyword_ids]
+        remaining = flat_budget[cells]
         
-    for neighbour in neighbours:        
+        # Padding entries have an infinite bid, so they are never affordable
+        affordable = bids <= remaining
         
-        function_X_u = compute_function_X_u(advertisers, advertiser_budget, neighbour)
-        bid = advertisers[neighbour].bids[query]  
-                
-        if function_X_u * bid > max_value and bid <= advertisers[neighbour].budget:            
-            max_bid = bid
-            max_bidder = neighbour
-            max_value = function_X_u * bid
+        if method == 'greedy':
+            score = bids
+        elif method == 'msvv':
+            # Only the affordable entries are scored, the others would give inf * 0 or 0/0
+            initial = initial_budget[neighbours]
+            spent = np.divide(initial - remaining, initial, out=np.zeros_like(remaining), where=affordable)
+            score = (1 - np.exp(spent - 1)) * np.where(affordable, bids, 0.0)
+        else:
+            score = remaining
             
-    advertisers[max_bidder].budget -= max_bid
-    
-    return max_bid
+        score = np.where(affordable, score, -np.inf)
+        best = picks + score.argmax(axis=1)
+        
+        winning_bids = np.where(score.ravel()[best] > -np.inf, bids.ravel()[best], 0.0)
+        
+        flat_budget[cells.ravel()[best]] -= winning_bids
+        revenues += winning_bids
+        
+    if optimum is None:
+        optimum = offline_optimum(engine, queries)
+        
+    return summarize_revenues(revenues, optimum)
 
 
-def process_cr_msvv():
-    """ This function will calculate the competitive ratio for MSVV approach"""
-        
-    total_revenue = 0.0
-    avg_revenue = 0.0
+def spawn_trial_seeds(seed, trials):
+    """ This function returns the seeds of the trials, spawned from the given one """
     
-    for x in range(0, 100):        
-        advertisers, advertiser_budget, query_neighbours = process_data() 
-        queries = get_queries()
+    return [int(child.generate_state(1)[0]) for child in np.random.SeedSequence(seed).spawn(trials)]
 
-        random.shuffle(queries)
 
-        total_revenue += msvv(queries, advertisers, advertiser_budget, query_neighbours)        
-        
-    avg_revenue = total_revenue/100    
-    competitive_ratio = avg_revenue/sum(advertiser_budget.values())
+def shuffle_queries(queries, seed):
+    """ This function returns the keyword ids in the random order drawn from the seed of a trial """
     
-    return competitive_ratio    
+    return np.asarray(queries)[np.random.default_rng(seed).permutation(len(queries))]
 
-#------------------------------------------------------------------------------------
 
-def balance(queries, advertisers, advertiser_budget, query_neighbours):
-    """ This function implements the balance algorithm in the documentation"""
+def summarize_revenues(revenues, optimum):
+    """ This function returns the mean competitive ratio of the trial revenues and its 95% confidence interval """
     
-    total_revenue = 0
+    ratios = np.asarray(revenues)/optimum
+    competitive_ratio = float(ratios.mean())
     
-    for query in queries:
-        neighbours = query_neighbours[query]             
-                
-        if has_sufficient_budget(advertisers, query, neighbours):             
-            
-            max_bid = get_highest_bid_balance(neighbours, advertisers, query, advertiser_budget)            
-            total_revenue += max_bid     
-            
-    return total_revenue
+    half_width = 1.96 * float(ratios.std(ddof=1))/math.sqrt(len(ratios)) if len(ratios) > 1 else 0.0
+    
+    return competitive_ratio, (competitive_ratio - half_width, competitive_ratio + half_width)
+
+#------------------------------------------------------------------------------------
 
-def get_highest_bid_balance(neighbours, advertisers, query, advertiser_budget):
-    """ This function returns the highest bid and decrements the bid from the advertiser's balance 
-        for the balance algorithm
+def offline_optimum(engine, queries, cache_dir='.adwords_cache'):
+    """ This function returns the offline optimal revenue of the queries, which knows the whole sequence in advance.
+        Queries of the same keyword are interchangeable, so the budgeted matching is solved as the LP relaxation
+        with one variable per bid: how many of its keyword's queries the bidder wins. Every keyword has the
+        queries to give away and every Advertiser its budget to spend. With many queries per keyword the LP
+        optimum is at most a few bids above the best integral allocation.
+        The result is cached on disk, keyed by a hash of the bids, budgets and query counts.
     """
     
-    max_bid = 0
-    max_bidder = 0
-    max_budget = -float("inf")
-        
-    for neighbour in neighbours:        
-                
-        bid = advertisers[neighbour].bids[query]  
-                
-        if advertisers[neighbour].budget > max_budget and bid <= advertisers[neighbour].budget:            
-            max_bid = bid
-            max_bidder = neighbour
-            max_budget = advertisers[neighbour].budget
-            
-    advertisers[max_bidder].budget -= max_bid
+    queries = np.asarray(queries)
+    counts = np.bincount(queries[queries >= 0], minlength=len(engine.rows)).astype(np.float64)
     
-    return max_bid
-
-
-def process_cr_balance():
-    """ This function will calculate the competitive ratio for Balance approach"""
-        
-    total_revenue = 0.0
-    avg_revenue = 0.0
+    digest = hashlib.sha256()
+    for array in [engine.offsets, engine.neighbours, engine.bids, engine.initial_budget, counts]:
+        digest.update(np.ascontiguousarray(array).tobytes())
+    path = os.path.join(cache_dir, 'optimum_' + digest.hexdigest() + '.json')
     
-    for x in range(0, 100):        
-        advertisers, advertiser_budget, query_neighbours = process_data() 
-        queries = get_queries()
-
-        random.shuffle(queries)
-
-        total_revenue += balance(queries, advertisers, advertiser_budget, query_neighbours)        
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)['optimum']
         
-    avg_revenue = total_revenue/100    
-    competitive_ratio = avg_revenue/sum(advertiser_budget.values())
+    bid_ids = np.arange(len(engine.bids))
+    keyword_of_bid = np.repeat(np.arange(len(engine.rows)), np.diff(engine.offsets))
+    
+    constraints = sparse.vstack([
+        sparse.csr_matrix((np.ones(len(engine.bids)), (keyword_of_bid, bid_ids)), 
+                          shape=(len(engine.rows), len(engine.bids))),
+        sparse.csr_matrix((engine.bids, (engine.neighbours, bid_ids)), 
+                          shape=(len(engine.initial_budget), len(engine.bids)))
+    ], format='csr')
+    limits = np.concatenate([counts, engine.initial_budget])
+    
+    result = linprog(-engine.bids, A_ub=constraints, b_ub=limits, bounds=(0, None), method='highs')
+    
+    if not result.success:
+        raise RuntimeError("The offline optimum could not be solved: " + result.message)
     
-    return competitive_ratio 
+    optimum = float(-result.fun)
+    
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'optimum': optimum}, f)
+        
+    return optimum
 
 #------------------------------------------------------------------------------------
 
-def main(method):
+def main(method, trials=100, workers=1, seed=0, batched=False):
     """ This is where all the action happens"""
     
-    queries = get_queries()
+    engine = AuctionEngine(process_data())
+    queries = engine.encode(get_queries())
     
-    advertisers, advertiser_budget, query_neighbours = process_data() 
-        
-    if method == 'greedy':        
-        
-        total_revenue = greedy(queries, advertisers, advertiser_budget, query_neighbours)    
-        print("{:0.2f}".format(total_revenue))
-        competitive_ratio = process_cr_greedy()
-        print("{:0.2f}".format(competitive_ratio))
-        
-    elif method == 'msvv':            
-        
-        total_revenue = msvv(queries, advertisers, advertiser_budget, query_neighbours)    
-        print("{:0.2f}".format(total_revenue))
-        competitive_ratio = process_cr_msvv()
-        print("{:0.2f}".format(competitive_ratio))
-        
+    total_revenue = allocate_queries(queries, engine, method)
+    print("{:0.2f}".format(total_revenue))
+    
+    optimum = offline_optimum(engine, queries)
+    
+    if batched:
+        competitive_ratio, (low, high) = process_cr_batched(engine, queries, method, trials, seed, optimum)
     else:
-        
-        total_revenue = balance(queries, advertisers, advertiser_budget, query_neighbours)
-        print("{:0.2f}".format(total_revenue))
-        competitive_ratio = process_cr_balance()
-        print("{:0.2f}".format(competitive_ratio))
+        competitive_ratio, (low, high) = process_cr(engine, queries, method, trials, workers, seed, optimum)
+    print("{:0.2f}".format(competitive_ratio))
+    print("95% confidence interval: [{:0.4f}, {:0.4f}]".format(low, high))
+
+
+def main_stream(method, path, interval):
+    """ This function replays a query stream, '-' for stdin, in the order it arrives """
+    
+    engine = AuctionEngine(process_data())
+    
+    if path == '-':
+        total_revenue, count = process_stream(engine, sys.stdin, method, interval)
+    else:
+        with open(path, 'r') as f:
+            total_revenue, count = process_stream(engine, f, method, interval)
+            
+    print("{} queries: {:0.2f}".format(count, total_revenue))
 
 #------------------------------------------------------------------------------------
 
 if __name__ == "__main__":
     
-    if len(sys.argv) == 2:
-        if sys.argv[1] in ['greedy', 'msvv', 'balance']:
-            main(sys.argv[1])
-        else:
-            print("Please enter a valid input!")
+    parser = argparse.ArgumentParser(description="Adwords placement using bipartite graph matching")
+    parser.add_argument('method', choices=['greedy', 'msvv', 'balance'])
+    parser.add_argument('--trials', type=int, default=100, help="number of shuffled trials for the competitive ratio")
+    parser.add_argument('--workers', type=int, default=1, help="number of worker processes, 0 for one per core")
+    parser.add_argument('--seed', type=int, default=0, help="seed the trial seeds are spawned from")
+    parser.add_argument('--batched', action='store_true', help="run all the trials together as one array simulation")
+    parser.add_argument('--stream', metavar='PATH', help="allocate the queries of PATH ('-' for stdin) as they arrive")
+    parser.add_argument('--interval', type=int, default=10000, help="queries between running revenue reports of --stream, 0 for none")
+    args = parser.parse_args()
+    
+    if args.interval < 0:
+        parser.error("--interval must not be negative")
+    if args.trials < 1:
+        parser.error("--trials must be at least 1")
+    if args.workers < 0:
+        parser.error("--workers must not be negative")
+    
+    if args.stream:
+        main_stream(args.method, args.stream, args.interval)
     else:
-        print("Please enter a valid input!")
+        main(args.method, args.trials, args.workers or os.cpu_count(), args.seed, args.batched)
@@ -0,0 +1,170 @@
+## Benchmark and profiling harness for the allocation algorithms of adwords.py
+
+import argparse
+import cProfile
+import json
+import os
+import platform
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import adwords
+
+METHODS = ['greedy', 'msvv', 'balance']
+
+#------------------------------------------------------------------------------------
+
+def keyword_popularity(keywords, skew):
+    """ This function returns the Zipf probabilities of the keywords: the one of rank r is proportional to 1/r^skew """
+
+    weights = 1.0/np.arange(1, keywords + 1)**skew
+    return weights/weights.sum()
+
+
+def generate_dataset(directory, advertisers, keywords, bids_per_advertiser, queries, skew, seed=0):
+    """ This function writes a synthetic bidder_dataset.csv and queries.txt into the directory.
+        Both the keywords advertisers bid on and the queries follow the Zipf popularity of the keywords,
+        so popular keywords get both more bidders and more queries.
+        Returns the paths of the two files.
+    """
+
+    rng = np.random.default_rng(seed)
+    popularity = keyword_popularity(keywords, skew)
+
+    bids = pd.DataFrame({
+        'Advertiser': np.repeat(np.arange(advertisers), bids_per_advertiser),
+        'Keyword': rng.choice(keywords, advertisers * bids_per_advertiser, p=popularity)
+    }).drop_duplicates()
+
+    bids['Keyword'] = 'keyword' + bids['Keyword'].astype(str)
+    bids['Bid Value'] = rng.integers(1, 50, len(bids))/10
+
+    # As in the course dataset, only the first row of every Advertiser carries its budget
+    budgets = rng.integers(50, 500, advertisers).astype(float)
+    bids['Budget'] = np.where(~bids['Advertiser'].duplicated(), budgets[bids['Advertiser']], np.nan)
+
+    bidder_path = os.path.join(directory, 'bidder_dataset.csv')
+    bids.to_csv(bidder_path, index=False)
+
+    # Only keywords somebody bids on are queried, as in queries.txt
+    bid_keywords = np.unique(bids['Keyword'].str[len('keyword'):].astype(int))
+    query_popularity = popularity[bid_keywords]/popularity[bid_keywords].sum()
+    query_ids = rng.choice(bid_keywords, queries, p=query_popularity)
+
+    queries_path = os.path.join(directory, 'queries.txt')
+    with open(queries_path, 'w') as f:
+        f.write('\n'.join('keyword' + str(query_id) for query_id in query_ids))
+        f.write('\n')
+
+    return bidder_path, queries_path
+
+#------------------------------------------------------------------------------------
+
+def timed(name, function, *args, profile_dir=None):
+    """ This function calls the function and returns its result and wall time in seconds.
+        With a profile_dir the call runs under cProfile and the stats are dumped to <name>.prof there.
+    """
+
+    profiler = cProfile.Profile() if profile_dir else None
+
+    start = time.perf_counter()
+    if profiler:
+        result = profiler.runcall(function, *args)
+    else:
+        result = function(*args)
+    elapsed = time.perf_counter() - start
+
+    if profiler:
+        profiler.dump_stats(os.path.join(profile_dir, name + '.prof'))
+
+    return result, elapsed
+
+
+def run_benchmark(bidder_path, queries_path, methods=METHODS, trials=10, profile_dir=None):
+    """ This function times loading, allocation and competitive-ratio estimation of every method separately
+        and returns the results as a JSON-serializable dictionary
+    """
+
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+
+    results = {'load': {}, 'methods': {}}
+
+    index, results['load']['process_data'] = timed('process_data', adwords.process_data, bidder_path,
+                                                   profile_dir=profile_dir)
+    engine, results['load']['engine'] = timed('engine', adwords.AuctionEngine, index, profile_dir=profile_dir)
+    raw_queries, results['load']['get_queries'] = timed('get_queries', adwords.get_queries, queries_path,
+                                                        profile_dir=profile_dir)
+    queries, results['load']['encode'] = timed('encode', engine.encode, raw_queries, profile_dir=profile_dir)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        optimum, results['optimum_seconds'] = timed('optimum', adwords.offline_optimum, engine, queries, cache_dir,
+                                                    profile_dir=profile_dir)
+    results['optimum'] = optimum
+
+    for method in methods:
+        engine.reset()
+        revenue, allocation = timed('allocate_' + method, adwords.allocate_queries, queries, engine, method,
+                                    profile_dir=profile_dir)
+
+        (ratio, interval), cr = timed('cr_' + method, adwords.process_cr, engine, queries, method, trials, 1, 0,
+                                      optimum, profile_dir=profile_dir)
+
+        (batched_ratio, _), cr_batched = timed('cr_batched_' + method, adwords.process_cr_batched, engine, queries,
+                                               method, trials, 0, optimum, profile_dir=profile_dir)
+
+        results['methods'][method] = {
+            'revenue': revenue,
+            'allocation_seconds': allocation,
+            'queries_per_second': len(queries)/allocation,
+            'competitive_ratio': ratio,
+            'confidence_interval': list(interval),
+            'cr_seconds': cr,
+            'cr_batched_seconds': cr_batched,
+            'cr_batched_competitive_ratio': batched_ratio
+        }
+
+    return results
+
+#------------------------------------------------------------------------------------
+
+def main(args):
+    """ This is where all the action happens"""
+
+    with tempfile.TemporaryDirectory() as directory:
+        (bidder_path, queries_path), generation = timed('generate', generate_dataset, directory, args.advertisers,
+                                                        args.keywords, args.bids_per_advertiser, args.queries,
+                                                        args.skew, args.seed)
+
+        results = run_benchmark(bidder_path, queries_path, args.methods, args.trials, args.profile)
+        results['generate_seconds'] = generation
+        results['bids'] = int(pd.read_csv(bidder_path, usecols=['Advertiser']).shape[0])
+
+    results['config'] = {name: value for name, value in vars(args).items() if name not in ['output', 'profile']}
+    results['python'] = platform.python_version()
+    results['numpy'] = np.__version__
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+#------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the adwords allocation algorithms on synthetic data")
+    parser.add_argument('--advertisers', type=int, default=1000)
+    parser.add_argument('--keywords', type=int, default=1000)
+    parser.add_argument('--bids-per-advertiser', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=100000)
+    parser.add_argument('--skew', type=float, default=1.0, help="Zipf exponent of the keyword popularity, 0 for uniform")
+    parser.add_argument('--trials', type=int, default=10, help="number of shuffled trials for the competitive ratio")
+    parser.add_argument('--methods', nargs='+', choices=METHODS, default=METHODS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', metavar='PATH', help="write the JSON results to PATH instead of stdout")
+    parser.add_argument('--profile', metavar='DIR', help="dump a cProfile .prof file of every timed stage into DIR")
+
+    main(parser.parse_args())
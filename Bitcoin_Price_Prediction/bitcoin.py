@@ -1,30 +1,114 @@
 import statsmodels.formula.api as smf
 import sklearn.metrics as sm
+from sklearn.neighbors import BallTree
 import pandas as pd
 import numpy as np
+import argparse
+import hashlib
+import collections
 import math
+import multiprocessing
+import os
 import sys
 
 
-# The path to the data folder should be given as input
-if len(sys.argv) != 2:
-    print('bitcoin.py <path to data folder>')
-    sys.exit(1)
-data_path = sys.argv[1]
+def normalizeWindows(windows):
+    """
+    This function z-normalizes every row of a matrix of price windows, so that the
+    similarity of Equation 9 between two windows becomes a dot product divided by m.
+
+    Parameters
+    ----------
+    windows : array_like
+        A (n, m) matrix with one price window per row.
+
+    Returns
+    -------
+    numpy.ndarray
+        The (n, m) matrix of rows with zero mean and unit (population) standard deviation.
+        A flat row has no deviation to scale and stays all zeros, so its similarity to any
+        window is 0 instead of 0/0.
+    """
+    windows = np.asarray(windows, dtype=np.float64)
+    std = windows.std(axis=1, keepdims=True)
+    return (windows - windows.mean(axis=1, keepdims=True)) / np.where(std > 0, std, 1.0)
+
+
+def predictDeltas(wt, X, Xi):
+    """
+    This function computes equation 6 for every row of X at once, with the similarity
+    function of Equation 9. The training windows are normalized once, all similarities
+    come from one matrix product and every prediction is a softmax-weighted sum of yi.
+
+    Parameters
+    ----------
+    wt : int
+        This is the constant c at the top of the right column on page 4.
+    X : Panda Dataframe
+        Corresponds to a dataframe of (x, y) in Equation 6, one per row.
+    Xi : Panda Dataframe
+        Corresponds to a dataframe of (xi, yi) in Equation 6.
+
+    Returns
+    -------
+    numpy.ndarray
+        The output of equation 6 for every row of X.
+    """
+    x = normalizeWindows(X.iloc[:, :-1])
+    xi = normalizeWindows(Xi.iloc[:, :-1])
+    yi = Xi.iloc[:, -1].to_numpy(dtype=np.float64)
+
+    return kernelRegression(wt, x, xi, yi)
+
+
+def kernelRegression(wt, x, xi, yi):
+    """
+    This function computes equation 6 for already normalized windows.
+
+    Parameters
+    ----------
+    wt : int
+        This is the constant c at the top of the right column on page 4.
+    x : numpy.ndarray
+        The (n, m) matrix of normalized windows x to predict for.
+    xi : numpy.ndarray
+        The (k, m) matrix of normalized training windows xi.
+    yi : numpy.ndarray
+        The k labels yi of the training windows.
+
+    Returns
+    -------
+    numpy.ndarray
+        The output of equation 6 for every row of x.
+    """
+    return weightedLabels(wt, x @ xi.T / x.shape[1], yi)
+
 
+def weightedLabels(wt, similarity, yi):
+    """
+    This function computes equation 6 from the similarities of Equation 9: the average
+    of the labels yi weighted by exp(wt * similarity).
 
-# Reading the vectors from the given csv files
-train1_90 = pd.read_csv(data_path+'/train1_90.csv')
-train1_180 = pd.read_csv(data_path+'/train1_180.csv')
-train1_360 = pd.read_csv(data_path+'/train1_360.csv')
+    Parameters
+    ----------
+    wt : int
+        This is the constant c at the top of the right column on page 4.
+    similarity : numpy.ndarray
+        The (n, k) matrix of similarities between the windows x and the training windows xi.
+    yi : numpy.ndarray
+        The k labels yi of the training windows.
+
+    Returns
+    -------
+    numpy.ndarray
+        The output of equation 6 for every row of similarity.
+    """
+    # Shifting by the row maximum leaves the ratio unchanged and keeps exp from overflowing
+    logits = wt * similarity
+    weights = np.exp(logits - logits.max(axis=1, keepdims=True))
 
-train2_90 = pd.read_csv(data_path+'/train2_90.csv')
-train2_180 = pd.read_csv(data_path+'/train2_180.csv')
-train2_360 = pd.read_csv(data_path+'/train2_360.csv')
+    return weights @ yi / weights.sum(axis=1)
 
-test_90 = pd.read_csv(data_path+'/test_90.csv')
-test_180 = pd.read_csv(data_path+'/test_180.csv')
-test_360 = pd.read_csv(data_path+'/test_360.csv')
 
 def computeDelta(wt, X, Xi):
     """
@@ -45,122 +129,736 @@ def computeDelta(wt, X, Xi):
     float
         The output of equation 6, a prediction of the average price change.
     """
-    # YOUR CODE GOES HERE
-    
-    # First we calculate the similarity measure given in equation 9.
-    
-    # Exclude the last row    
-    x = X.iloc[0:len(X) - 1]
-    numerator = 0
-    denominator = 0
-    
-    for i in range(0,len(Xi)):
-        y = Xi.iloc[i];
-        yi = y[-1]
-        
-        result = np.exp(wt * similarity_measure(x, y.iloc[0:(len(y)-1)] ));        
-        numerator += yi * result;
-        denominator += result;
-  
-    return numerator/denominator;
+    return predictDeltas(wt, X.to_frame().T, Xi)[0]
     
 
 def similarity_measure(x, y):
-    mean_x = np.mean(x)
-    mean_y = np.mean(y)
-    
-    std_x = np.std(x)
-    std_y = np.std(y)
+    x = normalizeWindows([x])[0]
+    y = normalizeWindows([y])[0]
+    return x @ y / len(x)
     
-    m = len(x)
-    numerator = 0
-    denominator = 0
-    
-    for i in range(0,m):
-        numerator += (x.iloc[i] - mean_x) * (y.iloc[i] - mean_y)
 
-    denominator = m * std_x * std_y;
-    return numerator/denominator;
-    
+# The formats a dataset is looked for in, fastest to read first
+DATASET_FORMATS = ['.parquet', '.feather', '.arrow', '.csv']
+
+
+def findDataset(data_path, name):
+    """
+    This function returns the file of a dataset in the data folder, preferring the
+    Parquet and Arrow copies, which load much faster than the csv file.
+
+    Parameters
+    ----------
+    data_path : str
+        The data folder.
+    name : str
+        The dataset, such as 'train2_90'.
+
+    Returns
+    -------
+    str
+        The path of the dataset file.
+    """
+    for extension in DATASET_FORMATS:
+        path = os.path.join(data_path, name + extension)
+        if os.path.exists(path):
+            return path
+
+    raise FileNotFoundError("No %s dataset in %s" % (name, data_path))
+
+
+def readDataset(path):
+    """
+    This function reads a dataset from a Parquet, Arrow (Feather) or csv file.
+
+    Parameters
+    ----------
+    path : str
+        The dataset file.
+
+    Returns
+    -------
+    Panda Dataframe
+        The (x, y) rows of the dataset.
+    """
+    extension = os.path.splitext(path)[1]
+    if extension == '.parquet':
+        return pd.read_parquet(path)
+    if extension in ['.feather', '.arrow']:
+        return pd.read_feather(path)
+    return pd.read_csv(path)
+
+
+def loadTrainingWindows(path, cache_path):
+    """
+    This function returns the normalized windows and the labels of a training dataset.
+    They are computed once and stored as .npy files in cache_path, keyed by a hash of the
+    dataset file, so later runs memory-map them instead of parsing and normalizing again.
+
+    Parameters
+    ----------
+    path : str
+        The dataset file of (xi, yi) rows.
+    cache_path : str
+        The folder of the cached .npy files.
+
+    Returns
+    -------
+    (numpy.ndarray, numpy.ndarray)
+        The read-only (k, m) matrix of normalized windows xi and the k labels yi.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    digest = digest.hexdigest()
+
+    windows_path = os.path.join(cache_path, digest + '_windows.npy')
+    labels_path = os.path.join(cache_path, digest + '_labels.npy')
+
+    if not (os.path.exists(windows_path) and os.path.exists(labels_path)):
+        Xi = readDataset(path)
+        os.makedirs(cache_path, exist_ok=True)
+
+        # Write under a temporary name first, so an interrupted run never leaves half a file behind
+        for target, array in [(windows_path, normalizeWindows(Xi.iloc[:, :-1])),
+                              (labels_path, Xi.iloc[:, -1].to_numpy(dtype=np.float64))]:
+            with open(target + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(target + '.tmp', target)
+
+    return np.load(windows_path, mmap_mode='r'), np.load(labels_path, mmap_mode='r')
+
+
+def kernelRegressionTopK(wt, x, tree, yi, k, tolerance=1e-3):
+    """
+    This function computes equation 6 for already normalized windows, but sums only over
+    the training windows most similar to each x. The rows of a z-normalized window all have
+    norm sqrt(m), so the most similar windows are the nearest ones in euclidean distance and
+    are found exactly with a ball tree.
+
+    Starting from k, the number of neighbours of a row is doubled until the weight the
+    skipped windows can carry, at most (n - k) exp(wt * s_k) for the k-th similarity s_k,
+    is below tolerance times the weight of the kept ones. The error of a prediction is then
+    at most tolerance * (max(yi) - min(yi)).
+
+    Parameters
+    ----------
+    wt : int
+        This is the constant c at the top of the right column on page 4.
+    x : numpy.ndarray
+        The (n, m) matrix of normalized windows x to predict for.
+    tree : sklearn.neighbors.BallTree
+        The ball tree over the normalized training windows xi.
+    yi : numpy.ndarray
+        The labels yi of the training windows.
+    k : int
+        The number of neighbours to start from.
+    tolerance : float
+        The bound on the skipped weight, relative to the kept one.
+
+    Returns
+    -------
+    numpy.ndarray
+        The output of equation 6 for every row of x.
+    """
+    m = x.shape[1]
+    n = len(yi)
+    predictions = np.empty(len(x))
+    pending = np.arange(len(x))
+
+    while len(pending):
+        k = min(k, n)
+        distances, neighbours = tree.query(x[pending], k=k)
+        similarity = 1 - distances**2 / (2 * m)
+
+        logits = wt * similarity
+        weights = np.exp(logits - logits[:, :1])
+        skipped = (n - k) * weights[:, -1]
+
+        done = (skipped <= tolerance * weights.sum(axis=1)) | (k == n)
+        predictions[pending[done]] = (weights[done] * yi[neighbours[done]]).sum(axis=1) / weights[done].sum(axis=1)
+
+        pending = pending[~done]
+        k *= 2
+
+    return predictions
+
+
+class BayesianRegressionPredictor:
+    """
+    This class predicts the average price change with the Bayesian regression of the paper:
+    equation 6 estimates it once per window length from the train1 windows, and the linear
+    model of equation 8, fitted on train2, combines the estimates. Every dataset is read
+    from the data folder the first time it is needed and kept, so a long-running process
+    pays the loading cost once.
+
+    Parameters
+    ----------
+    data_path : str
+        The data folder with the train1_<n>, train2_<n> and test_<n> datasets.
+    weight : float
+        This is the constant c at the top of the right column on page 4.
+    windows : tuple of int
+        The window lengths n.
+    topK : int
+        If given, equation 6 sums over the nearest training windows only, see kernelRegressionTopK.
+    tolerance : float
+        The bound on the skipped weight of topK.
+    cache_path : str
+        The folder of the cached normalized train1 windows, by default .cache in the data folder.
+    """
+    def __init__(self, data_path, weight=2, windows=(90, 180, 360), topK=None, tolerance=1e-3, cache_path=None):
+        self.data_path = data_path
+        self.weight = weight
+        self.windows = tuple(windows)
+        self.topK = topK
+        self.tolerance = tolerance
+        self.cache_path = cache_path or os.path.join(data_path, '.cache')
+        self.model = None
+        self.datasets = {}
+        self.training = {}
+        self.trees = {}
+
+    def dataset(self, name):
+        """
+        This function returns the dataset of the given name, reading it on first use.
+        """
+        if name not in self.datasets:
+            self.datasets[name] = readDataset(findDataset(self.data_path, name))
+        return self.datasets[name]
+
+    def trainingWindows(self, n):
+        """
+        This function returns the normalized train1 windows of length n and their labels.
+        """
+        if n not in self.training:
+            self.training[n] = loadTrainingWindows(findDataset(self.data_path, 'train1_%d' % n), self.cache_path)
+        return self.training[n]
+
+    def estimate(self, windows, n):
+        """
+        This function computes equation 6 for every row of a (k, n) matrix of price windows.
+        """
+        x = normalizeWindows(windows)
+        xi, yi = self.trainingWindows(n)
+
+        if self.topK:
+            if n not in self.trees:
+                self.trees[n] = BallTree(xi)
+            return kernelRegressionTopK(self.weight, x, self.trees[n], yi, self.topK, self.tolerance)
+
+        return kernelRegression(self.weight, x, xi, yi)
+
+    def features(self, split):
+        """
+        This function returns the deltaP<n> estimates of equation 6 for every row of the
+        train2 or test datasets, together with the actual deltaP.
+        """
+        data = pd.DataFrame({'deltaP%d' % n: self.estimate(self.dataset('%s_%d' % (split, n)).iloc[:, :-1], n)
+                             for n in self.windows})
+        data['deltaP'] = self.dataset('%s_%d' % (split, self.windows[-1]))['Yi'].to_numpy(dtype=np.float64)
+        return data
+
+    def fit(self):
+        """
+        This function fits the linear model of equation 8 on train2 and returns the predictor.
+        """
+        # Feed the data: [deltaP, deltaP90, deltaP180, deltaP360] to train the linear model.
+        formula = 'deltaP ~ ' + ' + '.join('deltaP%d' % n for n in self.windows)
+        self.model = smf.ols(formula = formula, data = self.features('train2')).fit()
+        return self
+
+    def predict(self, windows):
+        """
+        This function predicts the average price change, fitting the model first if needed.
 
+        Parameters
+        ----------
+        windows : dict
+            Maps every window length n to a (k, n) matrix, or a single row, of price differences.
 
-# Perform the Bayesian Regression to predict the average price change for each dataset of train2 using train1 as input. 
-# These will be used to estimate the coefficients (w0, w1, w2, and w3) in equation 8.
-weight = 2  # This constant was not specified in the paper, but we will use 2.
-trainDeltaP90 = np.empty(0)
-trainDeltaP180 = np.empty(0)
-trainDeltaP360 = np.empty(0)
-for i in range(0,len(train1_90.index)) :
-  trainDeltaP90 = np.append(trainDeltaP90, computeDelta(weight,train2_90.iloc[i],train1_90))
-for i in range(0,len(train1_180.index)) :
-  trainDeltaP180 = np.append(trainDeltaP180, computeDelta(weight,train2_180.iloc[i],train1_180))
-for i in range(0,len(train1_360.index)) :
-  trainDeltaP360 = np.append(trainDeltaP360, computeDelta(weight,train2_360.iloc[i],train1_360))
+        Returns
+        -------
+        numpy.ndarray
+            The k predictions.
+        """
+        if self.model is None:
+            self.fit()
 
+        data = pd.DataFrame({'deltaP%d' % n: self.estimate(np.atleast_2d(windows[n]), n) for n in self.windows})
+        return self.model.predict(data).to_numpy()
 
-# Actual deltaP values for the train2 data.
-trainDeltaP = np.asarray(train2_360[['Yi']])
-trainDeltaP = np.reshape(trainDeltaP, -1)
+    def predictLatest(self, differences):
+        """
+        This function predicts the average price change following a history of price
+        differences, the most recent last, at least as long as the longest window.
+        """
+        differences = np.asarray(differences, dtype=np.float64)
+        return self.predict({n: differences[-n:] for n in self.windows})[0]
 
+    def score(self):
+        """
+        This function returns the MSE of the predictions on the test data.
+        """
+        if self.model is None:
+            self.fit()
+
+        # Predict price variation on the test data set.
+        testData = self.features('test')
+        return sm.mean_squared_error(testData['deltaP'], self.model.predict(testData))
+
+
+class RingBuffer:
+    """
+    This class keeps the last size values of a stream. Every value is written twice, so
+    the last n values are always one contiguous slice and reading a window copies nothing.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.values = np.zeros(2 * size)
+        self.count = 0
+
+    def append(self, value):
+        i = self.count % self.size
+        self.values[i] = self.values[i + self.size] = value
+        self.count += 1
+
+    def last(self, n):
+        end = self.count % self.size + self.size
+        return self.values[end - n:end]
+
+
+class RecursiveLeastSquares:
+    """
+    This class updates the coefficients of a linear model one observation at a time, with
+    a constant cost per update instead of a refit. Started from a least squares fit, theta
+    and its (X'X)^-1, it stays equal to the least squares fit over all the observations so
+    far; a forgetting factor below 1 discounts old observations.
+    """
+    def __init__(self, theta, P, forgetting=1.0):
+        self.theta = np.array(theta, dtype=np.float64)
+        self.P = np.array(P, dtype=np.float64)
+        self.forgetting = forgetting
+
+    def predict(self, x):
+        return x @ self.theta
+
+    def update(self, x, y):
+        Px = self.P @ x
+        gain = Px / (self.forgetting + x @ Px)
+        self.theta += gain * (y - x @ self.theta)
+        self.P = (self.P - np.outer(gain, Px)) / self.forgetting
+
+
+def streamPredictions(ticks, predictor, horizon=1, forgetting=1.0, out=None):
+    """
+    This function predicts deltaP for every tick of a live price stream. The last price
+    differences are kept in a ring buffer, the windows of the predictor are read from it and
+    scored against train1 with equation 6, and equation 8 combines the estimates.
+    Once the price horizon ticks later is known, the price change is fed back to update the
+    coefficients of equation 8 with recursive least squares.
+
+    Parameters
+    ----------
+    ticks : iterable of str
+        Lines of 'time,price' or just 'price'; lines that do not end in a number are skipped.
+    predictor : BayesianRegressionPredictor
+        Its equation 8 model, fitted on train2 if needed, is the starting point of the coefficients.
+    horizon : int
+        The number of ticks ahead the predicted price change is measured at.
+    forgetting : float
+        The forgetting factor of the recursive least squares.
+    out : file
+        Where the 'time,prediction' lines are written, by default stdout.
+
+    Returns
+    -------
+    int
+        The number of predictions made.
+    """
+    if predictor.model is None:
+        predictor.fit()
+    out = out or sys.stdout
+
+    model = predictor.model
+    rls = RecursiveLeastSquares(model.params.to_numpy(), model.normalized_cov_params.to_numpy(), forgetting)
+    longest = max(predictor.windows)
+    differences = RingBuffer(longest)
+    pending = collections.deque()
+    lastPrice = None
+    count = 0
+
+    for tick, line in enumerate(ticks):
+        fields = line.strip().split(',')
+        try:
+            price = float(fields[-1])
+        except ValueError:
+            continue
+        time = fields[0] if len(fields) > 1 else str(tick)
+
+        if lastPrice is not None:
+            differences.append(price - lastPrice)
+        lastPrice = price
+
+        # The price change of a past prediction is known now, learn from it
+        if len(pending) == horizon:
+            x, pastPrice = pending.popleft()
+            if x is not None:
+                rls.update(x, price - pastPrice)
+
+        if differences.count < longest:
+            continue
+
+        x = np.array([1.0] + [predictor.estimate(differences.last(n)[None, :], n)[0] for n in predictor.windows])
+        if not np.all(np.isfinite(x)):
+            # Never let a non-finite observation into the coefficients, but keep the tick's
+            # place so that the later updates still pair prices horizon ticks apart
+            pending.append((None, price))
+            continue
+        pending.append((x, price))
+
+        out.write('%s,%f\n' % (time, rls.predict(x)))
+        count += 1
+
+    return count
+
+
+def initSweepWorker(state):
+    """
+    This function stores the read-only similarities of a sweep in a worker process.
+    """
+    global sweepState
+    sweepState = state
+
+
+def evaluateConfiguration(configuration):
+    """
+    This function fits equation 8 for one weight and set of window lengths from the
+    precomputed similarities and returns its MSE on the test data.
+
+    Parameters
+    ----------
+    configuration : (float, tuple of int)
+        The weight c and the window lengths.
+
+    Returns
+    -------
+    float
+        The MSE on the test data.
+    """
+    wt, windows = configuration
+    similarities, yi, trainDeltaP, testDeltaP = sweepState
+
+    trainData = pd.DataFrame({'deltaP': trainDeltaP})
+    testData = pd.DataFrame({'deltaP': testDeltaP})
+    for n in windows:
+        trainSimilarity, testSimilarity = similarities[n]
+        trainData['deltaP%d' % n] = weightedLabels(wt, trainSimilarity, yi)
+        testData['deltaP%d' % n] = weightedLabels(wt, testSimilarity, yi)
+
+    formula = 'deltaP ~ ' + ' + '.join('deltaP%d' % n for n in windows)
+    model = smf.ols(formula = formula, data = trainData).fit()
+
+    return sm.mean_squared_error(testDeltaP, model.predict(testData))
+
+
+def sweep(predictor, weights, windowSets, workers=1):
+    """
+    This function evaluates every combination of weight and window set and returns their
+    test MSE, best first. The windows of any length up to 360 are the last price
+    differences of the 360 windows, so the similarities of Equation 9 are computed once
+    per window length from those, and shared by all the weights and window sets.
+
+    Parameters
+    ----------
+    predictor : BayesianRegressionPredictor
+        The predictor whose datasets are used.
+    weights : list of float
+        The values of the constant c to try.
+    windowSets : list of tuple of int
+        The sets of window lengths to try.
+    workers : int
+        The number of worker processes.
+
+    Returns
+    -------
+    list of (float, tuple of int, float)
+        The weight, window lengths and MSE of every configuration, sorted by MSE.
+    """
+    train1, train2, test = [predictor.dataset(split + '_360') for split in ['train1', 'train2', 'test']]
+    yi = train1.iloc[:, -1].to_numpy(dtype=np.float64)
+
+    similarities = {}
+    for n in sorted(set(n for windows in windowSets for n in windows)):
+        xi = normalizeWindows(train1.iloc[:, -n-1:-1])
+        similarities[n] = tuple(normalizeWindows(X.iloc[:, -n-1:-1]) @ xi.T / n for X in [train2, test])
+
+    state = (similarities, yi, train2['Yi'].to_numpy(dtype=np.float64), test['Yi'].to_numpy(dtype=np.float64))
+    configurations = [(wt, windows) for wt in weights for windows in windowSets]
+
+    if workers == 1:
+        initSweepWorker(state)
+        errors = [evaluateConfiguration(configuration) for configuration in configurations]
+    else:
+        with multiprocessing.Pool(workers, initializer=initSweepWorker, initargs=(state,)) as pool:
+            errors = pool.map(evaluateConfiguration, configurations)
+
+    return sorted([(wt, windows, MSE) for (wt, windows), MSE in zip(configurations, errors)], key=lambda result: result[2])
+
+
+def priceSamples(prices, windows, stride):
+    """
+    This function cuts a price series into samples like the rows of the datasets: sample j
+    ends at tick max(windows) + j * stride, its windows are the last n price differences
+    before that tick and its label is the next price difference.
+
+    Parameters
+    ----------
+    prices : array_like
+        The price series.
+    windows : tuple of int
+        The window lengths n.
+    stride : int
+        The ticks between consecutive samples.
+
+    Returns
+    -------
+    (dict, numpy.ndarray)
+        The normalized (samples, n) windows of every window length and the labels.
+    """
+    differences = np.diff(np.asarray(prices, dtype=np.float64))
+    ends = np.arange(max(windows), len(differences), stride)
+
+    normalized = {n: normalizeWindows(np.lib.stride_tricks.sliding_window_view(differences, n)[ends - n])
+                  for n in windows}
+
+    return normalized, differences[ends]
+
+
+def bandedSimilarities(x, width):
+    """
+    This function computes the similarities of Equation 9 between every sample and the
+    width samples before it, all a walk-forward fold ever needs. Overlapping folds share
+    them, and memory grows with samples * width instead of samples squared.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        The (samples, n) matrix of normalized windows.
+    width : int
+        The number of earlier samples to compare with.
+
+    Returns
+    -------
+    numpy.ndarray
+        The (samples, width) band, band[i, k] is the similarity of samples i and i - width + k.
+    """
+    band = np.full((len(x), width), np.nan)
+    for k in range(width):
+        shift = width - k
+        if shift < len(x):
+            band[shift:, k] = np.einsum('ij,ij->i', x[shift:], x[:-shift]) / x.shape[1]
+    return band
+
+
+def initBacktestWorker(state):
+    """
+    This function stores the read-only similarities of a backtest in a worker process.
+    """
+    global backtestState
+    backtestState = state
+
+
+def backtestFold(start):
+    """
+    This function runs one walk-forward fold: train1, train2 and test are consecutive runs
+    of samples from start on, equation 8 is refitted on train2 and scored on test.
+    A simulated trader holds one unit long when the prediction is above the threshold,
+    one unit short when it is below minus the threshold, and nothing otherwise.
+
+    Parameters
+    ----------
+    start : int
+        The first sample of train1.
+
+    Returns
+    -------
+    dict
+        The MSE, directional accuracy, number of trades and P&L of the fold.
+    """
+    bands, labels, wt, sizes, threshold = backtestState
+    width = sum(sizes)
+    train1 = np.arange(start, start + sizes[0])
+    train2 = np.arange(start + sizes[0], start + sizes[0] + sizes[1])
+    test = np.arange(start + sizes[0] + sizes[1], start + width)
+
+    def estimates(rows):
+        # The similarity of rows i and train1 sample j sits at band[i, j - i + width]
+        return pd.DataFrame({'deltaP%d' % n: weightedLabels(wt, band[rows[:, None], train1[None, :] - rows[:, None] + width],
+                                                            labels[train1])
+                             for n, band in bands.items()})
+
+    trainData = estimates(train2)
+    trainData['deltaP'] = labels[train2]
+    formula = 'deltaP ~ ' + ' + '.join('deltaP%d' % n for n in bands)
+    model = smf.ols(formula = formula, data = trainData).fit()
+
+    predicted = model.predict(estimates(test)).to_numpy()
+    actual = labels[test]
+    position = np.where(predicted > threshold, 1, np.where(predicted < -threshold, -1, 0))
+
+    return {'start': int(start),
+            'MSE': float(sm.mean_squared_error(actual, predicted)),
+            'direction': float(np.mean(np.sign(predicted) == np.sign(actual))),
+            'trades': int(np.count_nonzero(position)),
+            'PnL': float(position @ actual)}
+
+
+def walkForward(prices, weight=2, windows=(90, 180, 360), sizes=(50, 50, 50), step=None, stride=60, 
+                threshold=0.0, workers=1):
+    """
+    This function backtests the Bayesian regression walk-forward: the train1/train2/test
+    split slides through the price series by step samples at a time and every fold refits
+    equation 8. The similarities are computed once for all the folds.
+
+    Parameters
+    ----------
+    prices : array_like
+        The price series.
+    weight : float
+        This is the constant c at the top of the right column on page 4.
+    windows : tuple of int
+        The window lengths n.
+    sizes : (int, int, int)
+        The number of samples of train1, train2 and test.
+    step : int
+        The samples between the starts of consecutive folds, by default the test size.
+    stride : int
+        The ticks between consecutive samples. With 360, the spacing of the fixed datasets,
+        the shipped price series only has room for the one fold of the fixed split.
+    threshold : float
+        The predicted price change the simulated trader needs to take a position.
+    workers : int
+        The number of worker processes.
+
+    Returns
+    -------
+    list of dict
+        The results of every fold, see backtestFold.
+    """
+    normalized, labels = priceSamples(prices, windows, stride)
+    bands = {n: bandedSimilarities(x, sum(sizes)) for n, x in normalized.items()}
+    starts = range(0, len(labels) - sum(sizes) + 1, step or sizes[2])
+
+    state = (bands, labels, weight, tuple(sizes), threshold)
+    if workers == 1:
+        initBacktestWorker(state)
+        return [backtestFold(start) for start in starts]
+
+    with multiprocessing.Pool(workers, initializer=initBacktestWorker, initargs=(state,)) as pool:
+        return pool.map(backtestFold, starts)
+
+
+def main(argv=None):
+    """
+    This is the command line interface of the predictor.
+    """
+    # The path to the data folder should be given as input
+    parser = argparse.ArgumentParser(description='Bitcoin price prediction with Bayesian regression')
+    parser.add_argument('data_path', help='path to the data folder')
+    parser.add_argument('--top-k', type=int, help='also predict from the k most similar windows only and compare the MSE')
+    parser.add_argument('--tolerance', type=float, default=1e-3, 
+                        help='bound on the weight of the skipped windows relative to the kept ones for --top-k')
+    parser.add_argument('--stream', metavar='PATH', 
+                        help="predict deltaP for every tick of a 'time,price' stream in PATH ('-' for stdin)")
+    parser.add_argument('--horizon', type=int, default=1, 
+                        help='ticks ahead the price change of --stream is measured at, to update the coefficients')
+    parser.add_argument('--forgetting', type=float, default=1.0, 
+                        help='forgetting factor in (0, 1] of the coefficient updates of --stream, 1 keeps all ticks')
+    parser.add_argument('--sweep-weights', type=float, nargs='+', metavar='C', 
+                        help='report the test MSE of every one of these weights c')
+    parser.add_argument('--sweep-windows', nargs='+', metavar='N,N,N', 
+                        help='report the test MSE of every one of these sets of window lengths, up to 360')
+    parser.add_argument('--backtest', action='store_true', 
+                        help='backtest walk-forward on the price series of the dataset in the data folder')
+    parser.add_argument('--fold-sizes', default='50,50,50', metavar='A,B,C', 
+                        help='samples of train1, train2 and test in every --backtest fold')
+    parser.add_argument('--step', type=int, help='samples between --backtest folds, by default the test size')
+    parser.add_argument('--stride', type=int, default=60, 
+                        help='ticks between consecutive --backtest samples; 360 spaces them as the fixed datasets '
+                             'and, with the default fold sizes, gives only the single fold of the fixed split')
+    parser.add_argument('--threshold', type=float, default=0.0, 
+                        help='predicted price change the simulated --backtest trader needs to take a position')
+    parser.add_argument('--workers', type=int, default=1, 
+                        help='worker processes of the sweep and the backtest, 0 for one per core')
+    args = parser.parse_args(argv)
 
-# Combine all the training data
-d = {'deltaP': trainDeltaP,
-     'deltaP90': trainDeltaP90,
-     'deltaP180': trainDeltaP180,
-     'deltaP360': trainDeltaP360 }
-trainData = pd.DataFrame(d)
+    weight = 2  # This constant was not specified in the paper, but we will use 2.
+    predictor = BayesianRegressionPredictor(args.data_path, weight)
 
+    if args.sweep_weights or args.sweep_windows:
+        # Report the test MSE of every weight and window set, best first
+        windowSets = [tuple(int(n) for n in windows.split(',')) for windows in args.sweep_windows or ['90,180,360']]
+        if any(n < 1 or n > 360 for windows in windowSets for n in windows):
+            parser.error('window lengths must be between 1 and 360')
 
-# Feed the data: [deltaP, deltaP90, deltaP180, deltaP360] to train the linear model. 
-# Use the statsmodels ols function.
-# Use the variable name model for your fitted model
-# YOUR CODE HERE
+        for wt, windows, MSE in sweep(predictor, args.sweep_weights or [weight], windowSets, 
+                                      args.workers or os.cpu_count()):
+            print("weight %g, windows %s: MSE %f" % (wt, ','.join(map(str, windows)), MSE))
 
-model = smf.ols(formula = 'deltaP ~ deltaP90 + deltaP180 + deltaP360',data = trainData).fit()
+    elif args.backtest:
+        # Report every fold and the totals of the walk-forward backtest
+        try:
+            sizes = [int(size) for size in args.fold_sizes.split(',')]
+        except ValueError:
+            sizes = []
+        if len(sizes) != 3 or min(sizes) < 1:
+            parser.error('--fold-sizes must be three positive integers A,B,C')
+        if args.stride < 1 or (args.step is not None and args.step < 1):
+            parser.error('--stride and --step must be positive')
 
-# Print the weights from the model
-print(model.params)
+        prices = predictor.dataset('dataset')['price']
+        folds = walkForward(prices, weight, predictor.windows, sizes, 
+                            args.step, args.stride, args.threshold, args.workers or os.cpu_count())
 
+        for fold in folds:
+            print("fold at sample %(start)d: MSE %(MSE)f, direction %(direction).3f, %(trades)d trades, P&L %(PnL)f" % fold)
+        if folds:
+            print("%d folds: mean MSE %f, mean direction %.3f, total P&L %f" % 
+                  (len(folds), np.mean([fold['MSE'] for fold in folds]), np.mean([fold['direction'] for fold in folds]), 
+                   sum(fold['PnL'] for fold in folds)))
 
-# Perform the Bayesian Regression to predict the average price change for each dataset of test using train1 as input.
-# This should be similar to above where it was computed for train2.
-# YOUR CODE HERE
-weight = 2  # This constant was not specified in the paper, but we will use 2.
-testDeltaP90 = np.empty(0)
-testDeltaP180 = np.empty(0)
-testDeltaP360 = np.empty(0)
-for i in range(0,len(train1_90.index)) :
-    testDeltaP90 = np.append(testDeltaP90, computeDelta(weight,test_90.iloc[i],train1_90))
-for i in range(0,len(train1_180.index)) :
-    testDeltaP180 = np.append(testDeltaP180, computeDelta(weight,test_180.iloc[i],train1_180))
-for i in range(0,len(train1_360.index)) :
-    testDeltaP360 = np.append(testDeltaP360, computeDelta(weight,test_360.iloc[i],train1_360))
+    elif args.stream:
+        # Predict every tick of the stream instead of the test data
+        if args.horizon < 1:
+            parser.error('--horizon must be positive')
+        if not 0 < args.forgetting <= 1:
+            parser.error('--forgetting must be in (0, 1]')
 
-# Actual deltaP values for test data.
-# YOUR CODE HERE (use the right variable names so the below code works)
-testDeltaP = np.asarray(test_360[['Yi']])
-testDeltaP = np.reshape(testDeltaP, -1)
+        if args.stream == '-':
+            streamPredictions(sys.stdin, predictor, args.horizon, args.forgetting)
+        else:
+            with open(args.stream, 'r') as f:
+                streamPredictions(f, predictor, args.horizon, args.forgetting)
 
+    else:
+        MSE = predictor.fit().score()
 
-# Combine all the test data
-d = {'deltaP': testDeltaP,
-     'deltaP90': testDeltaP90,
-     'deltaP180': testDeltaP180,
-     'deltaP360': testDeltaP360}
+        # Print the weights from the model
+        print(predictor.model.params)
 
-testData = pd.DataFrame(d)
+        # Print the MSE
+        print("The MSE is %f" % (MSE))
 
+        # Compare with the prediction over the top k windows only
+        if args.top_k:
+            topK = BayesianRegressionPredictor(args.data_path, weight, topK=args.top_k, tolerance=args.tolerance)
+            topKMSE = topK.fit().score()
 
-# Predict price variation on the test data set.
-result = model.predict(testData)
-compare = { 'Actual': testDeltaP,
-            'Predicted': result }
-compareDF = pd.DataFrame(compare)
+            print("The MSE over the top %d windows (tolerance %g) is %f, %+f from the exhaustive MSE" % 
+                  (args.top_k, args.tolerance, topKMSE, topKMSE - MSE))
 
 
-# Compute the MSE and print the result
-# HINT: consider using the sm.mean_squared_error function
-MSE = 0.0
-# YOUR CODE HERE
-MSE = sm.mean_squared_error(compareDF['Actual'], compareDF['Predicted'])
-print("The MSE is %f" % (MSE))
+if __name__ == '__main__':
+    main()
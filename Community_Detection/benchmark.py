@@ -0,0 +1,160 @@
+## Benchmark and profiling harness for the SAC1 community detection of sac1.py
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import time
+import igraph
+import numpy as np
+import sac1
+
+SIMILARITIES = ['dense', 'sparse']
+MODES = ['sequential', 'parallel']
+
+#------------------------------------------------------------------------------------
+
+def generate_attributed_sbm(vertices, communities, degree, mixing, attributes, signature, noise, seed=0):
+    """ This function generates an attributed stochastic block model with planted communities of equal size.
+        A vertex has on average degree edges, the fraction mixing of them to other communities.
+        Every community has signature attributes of its own out of the binary attributes; a vertex has each
+        attribute of its community with probability 1 - noise and each other attribute with probability noise.
+        Returns the graph, its V x attributes matrix and the planted community of every vertex.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    block_sizes = [len(block) for block in np.array_split(np.arange(vertices), communities)]
+    labels = np.repeat(np.arange(communities), block_sizes)
+
+    p_in = min(1.0, degree * (1 - mixing)/max(vertices/communities - 1, 1))
+    p_out = min(1.0, degree * mixing/max(vertices - vertices/communities, 1))
+    preferences = np.full((communities, communities), p_out)
+    np.fill_diagonal(preferences, p_in)
+
+    # igraph draws its random numbers from the random module
+    random.seed(seed)
+    g = igraph.Graph.SBM(pref_matrix=preferences.tolist(), block_sizes=block_sizes)
+
+    signatures = np.zeros((communities, attributes), dtype=bool)
+    for community in range(communities):
+        signatures[community, rng.choice(attributes, signature, replace=False)] = True
+
+    attribute_values = np.where(signatures[labels], rng.random((vertices, attributes)) >= noise,
+                                rng.random((vertices, attributes)) < noise).astype(np.float32)
+
+    return g, attribute_values, labels
+
+#------------------------------------------------------------------------------------
+
+def peak_rss_bytes():
+    """ This function returns the peak resident set size of the process so far """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_configuration(vertices, similarity, mode, args):
+    """ This function generates one graph and runs the SAC1 Algorithm on it.
+        It times the generation, the similarities, every phase1 sweep and every contraction, and measures
+        the peak memory and the modularity and NMI of the communities against the planted ones.
+        It runs in a process of its own, so that the peak memory is the one of this configuration alone.
+    """
+
+    start = time.perf_counter()
+    g, attribute_values, labels = generate_attributed_sbm(vertices, args.communities, args.degree, args.mixing,
+                                                          args.attributes, args.signature, args.noise, args.seed)
+    generation = time.perf_counter() - start
+    rss_start = peak_rss_bytes()
+
+    start = time.perf_counter()
+    sac1.prepare_attribute_similarity(attribute_values, similarity == 'sparse')
+    similarity_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    levels = sac1.multilevel(g, attribute_values, args.alpha, similarity == 'sparse', prepared=True,
+                             parallel=mode == 'parallel')
+    total = time.perf_counter() - start
+
+    membership = levels[-1]['membership'].tolist()
+
+    return {
+        'vertices': vertices,
+        'edges': g.ecount(),
+        'similarity': similarity,
+        'mode': mode,
+        'generate_seconds': generation,
+        'similarity_seconds': similarity_seconds,
+        'multilevel_seconds': total,
+        'levels': [{
+            'communities': len(level['communities']),
+            'modularity': level['modularity'],
+            'similarity_seconds': level['similarity_seconds'],
+            'contraction_seconds': level['contraction_seconds'],
+            'sweeps': level['sweeps']
+        } for level in levels],
+        'communities': len(levels[-1]['communities']),
+        'modularity': levels[-1]['modularity'],
+        'planted_modularity': g.modularity(labels.tolist()),
+        'nmi': igraph.compare_communities(labels.tolist(), membership, method='nmi'),
+        'rss_start_bytes': rss_start,
+        'peak_rss_bytes': peak_rss_bytes()
+    }
+
+
+def run_benchmark(args):
+    """ This function runs every combination of size, similarity and mode, each in a fresh process,
+        and returns the results as a JSON-serializable list
+    """
+
+    results = []
+    for vertices, similarity, mode in itertools.product(args.sizes, args.similarities, args.modes):
+        with multiprocessing.Pool(1) as pool:
+            results.append(pool.apply(run_configuration, (vertices, similarity, mode, args)))
+
+    return results
+
+#------------------------------------------------------------------------------------
+
+def main(args):
+    """ This is where all the action happens"""
+
+    results = {
+        'runs': run_benchmark(args),
+        'config': {name: value for name, value in vars(args).items() if name != 'output'},
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'igraph': igraph.__version__
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+#------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark SAC1 on attributed stochastic block models")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[500, 1000, 2000, 4000], help="numbers of vertices")
+    parser.add_argument('--communities', type=int, default=10, help="number of planted communities")
+    parser.add_argument('--degree', type=float, default=20, help="expected degree of a vertex")
+    parser.add_argument('--mixing', type=float, default=0.2, help="expected fraction of edges between communities")
+    parser.add_argument('--attributes', type=int, default=60, help="number of binary attributes")
+    parser.add_argument('--signature', type=int, default=6, help="number of attributes typical of a community")
+    parser.add_argument('--noise', type=float, default=0.05, help="probability of flipping an attribute")
+    parser.add_argument('--alpha', type=float, default=0.5)
+    parser.add_argument('--similarities', nargs='+', choices=SIMILARITIES, default=SIMILARITIES)
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', metavar='PATH', help="write the JSON results to PATH instead of stdout")
+
+    main(parser.parse_args())
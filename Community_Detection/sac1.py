@@ -3,40 +3,126 @@
 
 import pandas as pd
 import numpy as np
+import argparse
 import csv
+import hashlib
+import multiprocessing
+import os
+import time
+import scipy.sparse
 from igraph import *
-from scipy import spatial
 
+# What compute_delta_Q_attr reads, see prepare_attribute_similarity
+similarity_matrix = None
+attributes = None
 
-def simA(i, j, g):
-    """ This function simulates the simA(i, j) from the reference.
+
+def read_edges(path, chunk_size=1 << 20):
+    """ This function parses an edge list of whitespace separated vertex pairs chunk by chunk into an E x 2 array """
+
+    chunks = pd.read_csv(path, sep=r'\s+', header=None, usecols=[0, 1], dtype=np.int64, chunksize=chunk_size)
+
+    return np.concatenate([chunk.to_numpy() for chunk in chunks])
+
+
+def read_attributes(path, chunk_size=1 << 16):
+    """ This function parses the attribute list, one row of attribute values per vertex under a header,
+        chunk by chunk into a V x attributes array """
+
+    chunks = pd.read_csv(path, dtype=np.float32, chunksize=chunk_size)
+
+    return np.concatenate([chunk.to_numpy() for chunk in chunks])
+
+
+def load_graph(attribute_path, edge_path, cache_dir='.sac1_cache'):
+    """ This function loads the graph with one vertex per row of the attribute list and its attribute matrix.
+        The parsed arrays are cached as an .npz file in cache_dir, keyed by a hash of both files, so later runs
+        only read them back; without a cache_dir the files are always parsed.
+        The graph is built from the edge array in one call and carries no vertex attributes """
+
+    cache_path = None
+    if cache_dir:
+        digest = hashlib.sha256()
+        for path in [attribute_path, edge_path]:
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+        cache_path = os.path.join(cache_dir, 'graph_' + digest.hexdigest() + '.npz')
+
+    if cache_path and os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            edges, attribute_values = cached['edges'], cached['attributes']
+
+    else:
+        edges, attribute_values = read_edges(edge_path), read_attributes(attribute_path)
+
+        if cache_path:
+            os.makedirs(cache_dir, exist_ok=True)
+
+            # Write under a temporary name first, so an interrupted run never leaves half a file behind
+            with open(cache_path + '.tmp', 'wb') as f:
+                np.savez(f, edges=edges, attributes=attribute_values)
+            os.replace(cache_path + '.tmp', cache_path)
+
+    return Graph(n=len(attribute_values), edges=edges), attribute_values
+
+
+def normalized_attributes(attribute_values, dtype=np.float64):
+    """ This function scales the attribute vector of every vertex to unit length, so that the cosine
+        similarity of two vertices is the dot product of their rows """
+
+    X = np.asarray(attribute_values, dtype=np.float64)
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+
+    # A vertex without any attribute is not similar to anything
+    norms[norms == 0] = 1
+    return (X/norms).astype(dtype)
+
+
+def compute_similarity_matrix(attribute_values, block_size=1024):
+    """ This function calculates the similarity matrix using cosine function.
+        It simulates the simA(i, j) from the reference for all the pairs at once: with normalized attribute
+        rows a block of rows of the matrix is a single matrix product. Only the blocks on and above the
+        diagonal are multiplied, the ones below are copied from their transpose.
         Reference: Section 4 A from Community Detection based on Structural and Attribute Similarities paper"""
-    
-    vertex1_attr_values = list(g.vs[i].attributes().values())
-    vertex2_attr_values = list(g.vs[j].attributes().values())      
-    
-    return 1 - spatial.distance.cosine(vertex1_attr_values, vertex2_attr_values)
 
+    X = normalized_attributes(attribute_values, similarity_matrix.dtype)
 
-def compute_similarity_matrix(g):
-    """ This function calculates the similarity matrix using cosine function """   
-    
-    v_count = len(g.vs)    
-    for i in range(v_count):
-        for j in range(v_count):              
-            similarity_matrix[i][j] = simA(i, j, g)
-    
-    return similarity_matrix  
+    v_count = len(X)
+    for start in range(0, v_count, block_size):
+        stop = min(start + block_size, v_count)
+        similarity_matrix[start:stop, start:v_count] = X[start:stop] @ X[start:].T
+        similarity_matrix[stop:v_count, start:stop] = similarity_matrix[start:stop, stop:v_count].T
 
+    return similarity_matrix
 
-def composite_modularity_gain(g, v_x, community, alpha, current_community, communities):
+
+def compute_community_attribute_sums(communities):
+    """ This function sums the normalized attribute vectors of the members of every community.
+        The sum of the similarities between a vertex and a community is the dot product of the vertex's
+        normalized attribute vector with the community's sum, so the sparse mode keeps these V x attributes
+        sums up to date instead of the V x V similarity matrix. Returns a communities x attributes array """
+
+    return np.array([attributes[community].sum(axis=0) for community in communities])
+
+
+def prepare_attribute_similarity(attribute_values, sparse):
+    """ This function prepares what compute_delta_Q_attr reads for vertices with the given attribute matrix:
+        the normalized attribute vectors in the sparse mode, a new similarity matrix otherwise """
+
+    global attributes, similarity_matrix
+    if sparse:
+        attributes = normalized_attributes(attribute_values)
+    else:
+        similarity_matrix = np.zeros((len(attribute_values), len(attribute_values)), dtype=np.float32)
+        compute_similarity_matrix(attribute_values)
+
+
+def composite_modularity_gain(g, v_x, community, alpha, delta_Q_newman, attribute_sum=None):
     """ This function computes the modularity gain """
     
-    # Get the delta Q Newman modularity
-    delta_Q_newman = compute_delta_Q_newman(g,v_x, community, current_community, communities)
-    
     # Get the delta attr modularity
-    delta_Q_attr = compute_delta_Q_attr(g, v_x, community)
+    delta_Q_attr = compute_delta_Q_attr(g, v_x, community, attribute_sum)
     
     # Compute delta Q which is the composite modularity gain
     delta_Q = alpha * delta_Q_newman + (1 - alpha) * delta_Q_attr
@@ -44,31 +130,27 @@ def composite_modularity_gain(g, v_x, community, alpha, current_community, commu
     return delta_Q
 
 
-def compute_delta_Q_newman(g ,v_x, new_community, current_community, communities):   
-    """ This function calculates the delta_Q_newman: It simulates the Delta_Q_Newman from the Reference.
+def compute_delta_Q_newman(m, degree, weight_to_new, weight_to_current, total_new, total_current):
+    """ This function calculates the delta_Q_newman of moving a vertex with the given degree from its current
+        community into the new one. It simulates the Delta_Q_Newman from the Reference in constant time, as in
+        Louvain: weight_to_* are the numbers of edges between the vertex and the other members of a community
+        and total_* the total degrees of the communities without the vertex.
         Reference: Section 4 A from Community Detection based on Structural and Attribute Similarities paper"""
 
-    # Get Vertex to community mapping
-    vertex_community_mapping = get_vertex_to_community_map(g, communities)    
-    
-    # Get the old modularity
-    old_mod = g.modularity(vertex_community_mapping)
-    
-    # Get index of the new community
-    index = communities.index(new_community)    
+    if m == 0:
+        return 0.0
 
-    # Update the community of the vertex to the new community(index) that we get in the previous step
-    vertex_community_mapping[v_x] = index   
-    
-    # Get the new modularity
-    new_mod = g.modularity(vertex_community_mapping)
-            
-    return new_mod - old_mod        
+    return (weight_to_new - weight_to_current)/m - degree * (total_new - total_current)/(2.0 * m * m)
 
-def compute_delta_Q_attr(g, v_x, community):
+def compute_delta_Q_attr(g, v_x, community, attribute_sum=None):
     """ This function calculates the delta_Q_attr. It simulates the Delta_Q_Attr from the Reference.
+        Given the attribute sum of the community (sparse mode) it is a single dot product, otherwise
+        the similarities are read from the similarity matrix.
         Reference: Section 4 A from Community Detection based on Structural and Attribute Similarities paper """
     
+    if attribute_sum is not None:
+        return float(attributes[v_x] @ attribute_sum)/len(community)
+
     summation = 0.0    
     for v_i in community:        
         summation += similarity_matrix[v_x][v_i]
@@ -76,17 +158,6 @@ def compute_delta_Q_attr(g, v_x, community):
     return summation/len(community)
 
 
-def get_community(g, communities, v_x):
-    """ This function finds out the community of a given vertex """
-    
-    comm = []
-    for community in communities:
-        if v_x in community:
-            comm = community
-            break
-    return comm
-
-
 def get_vertex_to_community_map(g, communities):
     """ This function assigns the respective community to each vertex thus creating a mapping """
     
@@ -99,83 +170,478 @@ def get_vertex_to_community_map(g, communities):
     return vertex_to_community_mapping
 
 
-def is_similar(community1, community2):
-    """ This function checks if the 2 communities are similar """
-        
-    c1 = set(community1)
-    c2 = set(community2)
-    
-    if c1 == c2:
-        return True
+def weighted_adjacency(g):
+    """ This function returns the (neighbour, weight) pairs of the edges of every vertex with the loops left out,
+        the weighted degree of every vertex and the total edge weight. Without a weight attribute every edge
+        weighs 1, as in the input graph; the contracted graphs of phase2 carry their weights """
+
+    weights = g.es['weight'] if 'weight' in g.es.attributes() else [1] * g.ecount()
+
+    adjacency = [[] for _ in range(g.vcount())]
+    for (source, target), weight in zip(g.get_edgelist(), weights):
+        if source != target:
+            adjacency[source].append((target, weight))
+            adjacency[target].append((source, weight))
+
+    return adjacency, g.strength(weights=weights), sum(weights)
+
+
+def adjacency_arrays(adjacency):
+    """ This function packs the adjacency lists of weighted_adjacency into arrays: the (neighbour, weight) pairs
+        of vertex v are at positions offsets[v] to offsets[v + 1] of neighbours and weights """
+
+    offsets = np.zeros(len(adjacency) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(pairs) for pairs in adjacency])
+
+    pairs = np.array([pair for pairs in adjacency for pair in pairs], dtype=np.float64).reshape(-1, 2)
+
+    return offsets, pairs[:, 0].astype(np.int64), pairs[:, 1]
+
+
+class CommunityStore:
+    """ This class keeps the communities of phase1 in arrays indexed by community ID: the community of every
+        vertex, the members, the total degree and (sparse mode) the attribute sum of every community.
+        IDs are stable, an emptied community keeps its ID without members, so looking up the community of
+        a vertex, moving a vertex and removing an empty community all take constant time.
+        With arrays the per-vertex and per-community values are NumPy arrays, so that they can be indexed
+        by whole batches of vertices; lists are faster for one vertex at a time """
+
+    def __init__(self, communities, degrees, sparse=False, arrays=False):
+        """ The i-th community of the communities list gets the ID i """
+
+        self.degrees = degrees
+        self.membership = [0] * len(degrees)
+        self.members = [set(community) for community in communities]
+        self.size = [len(community) for community in communities]
+        self.total_degree = [sum(degrees[v] for v in community) for community in communities]
+        self.attribute_sums = compute_community_attribute_sums(communities) if sparse else None
+
+        for c, community in enumerate(communities):
+            for v in community:
+                self.membership[v] = c
+
+        if arrays:
+            self.degrees = np.array(self.degrees, dtype=np.float64)
+            self.membership = np.array(self.membership, dtype=np.int64)
+            self.size = np.array(self.size, dtype=np.int64)
+            self.total_degree = np.array(self.total_degree, dtype=np.float64)
+
+
+    def move(self, v, target):
+        """ This function moves the vertex v into the community with the ID target """
+
+        source = self.membership[v]
+
+        self.members[source].remove(v)
+        self.members[target].add(v)
+        self.membership[v] = target
+
+        self.size[source] -= 1
+        self.size[target] += 1
+
+        self.total_degree[source] -= self.degrees[v]
+        self.total_degree[target] += self.degrees[v]
+
+        if self.attribute_sums is not None:
+            self.attribute_sums[source] -= attributes[v]
+            self.attribute_sums[target] += attributes[v]
+
+
+    def communities(self):
+        """ This function lists the sorted members of the non-empty communities in the order of their IDs """
+
+        return [sorted(members) for members in self.members if members]
+
+
+def community_similarity_sums(vertices, communities, store, block_size=256):
+    """ This function sums the similarities between vertices[i] and the members of communities[i] for every i.
+        Blocks of rows of the similarity matrix are multiplied with the vertex-community indicator matrix """
+
+    n = len(store.membership)
+    indicator = scipy.sparse.csr_matrix((np.ones(n, dtype=similarity_matrix.dtype), (np.arange(n), store.membership)),
+                                        shape=(n, len(store.size)))
+
+    rows, row_of = np.unique(vertices, return_inverse=True)
+    row_of = row_of.ravel()
+
+    sums = np.empty(len(vertices))
+    for start in range(0, len(rows), block_size):
+        block = np.asarray(similarity_matrix[rows[start:start + block_size], :n] @ indicator)
+        in_block = (row_of >= start) & (row_of < start + block_size)
+        sums[in_block] = block[row_of[in_block] - start, communities[in_block]]
+
+    return sums
+
+
+def composite_modularity(g, alpha, store, sparse):
+    """ This function computes the composite modularity alpha * Q_newman + (1 - alpha) * Q_attr of the communities
+        in the store, where Q_attr adds up the similarities of the pairs of members of every community divided by
+        its size. A move into a community raises Q_attr by about its delta_Q_attr, but also lowers it by what the
+        vertex took to its old community, so unlike the sum of the gains of the moves its change can fall to 0 """
+
+    membership = np.asarray(store.membership)
+    size = np.asarray(store.size, dtype=np.float64)
+    k = len(size)
+
+    # Similarities within every community, every pair twice and without the similarity of a vertex to itself
+    if sparse:
+        self_similarity = np.einsum('ij,ij->i', attributes, attributes)
+        within = (np.einsum('ij,ij->i', store.attribute_sums, store.attribute_sums)
+                  - np.bincount(membership, weights=self_similarity, minlength=k))
     else:
-        return False
+        n = len(membership)
+        sums = community_similarity_sums(np.arange(n), membership, store) - np.diagonal(similarity_matrix)[:n]
+        within = np.bincount(membership, weights=sums, minlength=k)
+
+    nonempty = size > 0
+    Q_attr = np.sum(within[nonempty]/size[nonempty])/2
+
+    weights = g.es['weight'] if 'weight' in g.es.attributes() else None
+    Q_newman = g.modularity(membership.tolist(), weights=weights)
+
+    return alpha * Q_newman + (1 - alpha) * Q_attr
+
+
+def best_moves(batch, store, adjacency, alpha, m, sparse):
+    """ This function evaluates the moves of a whole batch of vertices at once against the current communities.
+        It is the loop body of phase1 in NumPy: the candidates of a vertex are the communities it has edges into
+        and the best is the one with the highest composite gain, the lowest ID among equal gains.
+        Returns the vertices with a positive best gain, their best communities and their edge weights into
+        those and into their current communities """
+
+    offsets, neighbours, weights = adjacency
+
+    # Positions in neighbours and weights of the edges of the batch
+    counts = offsets[batch + 1] - offsets[batch]
+    position = np.repeat(np.arange(len(batch)), counts)
+    edges = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(offsets[batch], counts)
+
+    # Count the edges from every vertex into every community it is adjacent to
+    k = len(store.size)
+    pairs, combined = np.unique(position * k + store.membership[neighbours[edges]], return_inverse=True)
+    pair_weights = np.bincount(combined.ravel(), weights=weights[edges], minlength=len(pairs))
+    position, c = pairs // k, pairs % k
+
+    v = batch[position]
+    current = store.membership[v]
+    is_current = c == current
+
+    weight_to_current = np.zeros(len(batch))
+    weight_to_current[position[is_current]] = pair_weights[is_current]
+
+    candidate = ~is_current
+    position, c, v, current, weight_to_new = (position[candidate], c[candidate], v[candidate], current[candidate],
+                                              pair_weights[candidate])
+
+    degree = store.degrees[v]
+    total_current = store.total_degree[current] - degree
+
+    if m == 0:
+        delta_Q_newman = np.zeros(len(v))
+    else:
+        delta_Q_newman = ((weight_to_new - weight_to_current[position])/m
+                          - degree * (store.total_degree[c] - total_current)/(2.0 * m * m))
+
+    if sparse:
+        delta_Q_attr = np.einsum('ij,ij->i', attributes[v], store.attribute_sums[c])/store.size[c]
+    else:
+        delta_Q_attr = community_similarity_sums(v, c, store)/store.size[c]
+
+    delta_Q = alpha * delta_Q_newman + (1 - alpha) * delta_Q_attr
+
+    # Best community of every vertex
+    order = np.lexsort((c, -delta_Q, position))
+    best = order[np.diff(position[order], prepend=-1) != 0]
+    best = best[delta_Q[best] > 0]
+
+    return v[best], c[best], weight_to_new[best], weight_to_current[position[best]]
 
 
-def phase1(g, alpha, communities):
-    """ This function simulate the phase 1 of the SAC Algorithm
+def parallel_sweep(g, alpha, store, worklist, adjacency, colours, m, sparse):
+    """ This function is one synchronous sweep of phase1: the vertices of the worklist are split into batches by
+        colour, so that no two vertices of a batch are adjacent, and the best moves of a batch are evaluated
+        together by best_moves. The moves are then applied in vertex order; as the earlier moves of the batch
+        change the communities, the gain of every move is computed again first and the conflicting moves,
+        whose gain is no longer positive, are dropped.
+        Returns the moved vertices and the number of conflicts """
+
+    worklist = np.asarray(worklist, dtype=np.int64)
+    worklist_colours = colours[worklist]
+
+    moved = []
+    conflicts = 0
+
+    for colour in np.unique(worklist_colours):
+        batch = worklist[worklist_colours == colour]
+
+        for v_x, c, weight_to_new, weight_to_current in zip(*(values.tolist() for values in
+                                                              best_moves(batch, store, adjacency, alpha, m, sparse))):
+
+            delta_Q_newman = compute_delta_Q_newman(m, store.degrees[v_x], weight_to_new, weight_to_current,
+                                                    store.total_degree[c],
+                                                    store.total_degree[store.membership[v_x]] - store.degrees[v_x])
+
+            attribute_sum = store.attribute_sums[c] if sparse else None
+            delta_Q = composite_modularity_gain(g, v_x, store.members[c], alpha, delta_Q_newman, attribute_sum)
+
+            if delta_Q > 0:
+                store.move(v_x, c)
+                moved.append(v_x)
+            else:
+                conflicts += 1
+
+    return moved, conflicts
+
+
+def phase1(g, alpha, communities, sparse=False, max_sweeps=15, threshold=0.0, parallel=False):
+    """ This function simulate the phase 1 of the SAC Algorithm.
+        The communities are kept in a CommunityStore, so only the communities a vertex has edges into are
+        candidates and their gain is computed in constant time. Edge weights are taken into account.
+        The first sweep visits every vertex, later ones only the vertices that moved in the previous sweep
+        and their neighbours. The gain of a sweep is the change of the composite_modularity of the communities;
+        sweeping stops after a sweep without moves, a sweep whose gain is not above the threshold, or max_sweeps
+        sweeps.
+        In the parallel mode every sweep is a parallel_sweep instead, whose statistics count the conflicts too.
+        Returns the communities and the statistics of every sweep (see report_sweeps).
         Reference: Section 4 A from Community Detection based on Structural and Attribute Similarities paper """
 
-    i = 0
-        
-    while(i < 15):
+    adjacency, degrees, m = weighted_adjacency(g)
+
+    store = CommunityStore(communities, degrees, sparse, arrays=parallel)
+
+    if parallel:
+        arrays = adjacency_arrays(adjacency)
+        colours = np.array(g.vertex_coloring_greedy())
+
+    sweeps = []
+    worklist = range(g.vcount())
+    modularity = composite_modularity(g, alpha, store, sparse)
         
-        for v_x in range(g.vcount()):
+    while len(sweeps) < max_sweeps and len(worklist) > 0:
+
+        start = time.perf_counter()
+        moved = []
+
+        if parallel:
+            moved, conflicts = parallel_sweep(g, alpha, store, worklist, arrays, colours, m, sparse)
+
+        else:
+            for v_x in worklist:
             
-            # Get the community to which v_x belongs
-            current_community = get_community(g, communities, v_x)
-            new_community = []
-            max_gain = -1
+                # Get the community to which v_x belongs
+                current_index = store.membership[v_x]
+
+                # Count the edges from v_x into every community it is adjacent to
+                neighbour_weights = {}
+                for neighbour, weight in adjacency[v_x]:
+                    c = store.membership[neighbour]
+                    neighbour_weights[c] = neighbour_weights.get(c, 0) + weight
+
+                weight_to_current = neighbour_weights.pop(current_index, 0)
+                total_current = store.total_degree[current_index] - degrees[v_x]
+
+                max_gain = -1
             
-            for community in communities:
+                for c in sorted(neighbour_weights):
+                    attribute_sum = store.attribute_sums[c] if sparse else None
+
+                    delta_Q_newman = compute_delta_Q_newman(m, degrees[v_x], neighbour_weights[c], weight_to_current,
+                                                            store.total_degree[c], total_current)
                 
-                if not is_similar(current_community, community):
-                    
                     # Compute composite modularity gain
-                    delta_Q = composite_modularity_gain(g, v_x, community, alpha, current_community, communities)
-                    
+                    delta_Q = composite_modularity_gain(g, v_x, store.members[c], alpha, delta_Q_newman, attribute_sum)
+                
                     # Selecting community with maximum gain for a given vertex
                     if(delta_Q > max_gain and delta_Q > 0):
                         max_gain = delta_Q
-                        new_community = community
+                        new_index = c
             
-            # If maximum gain is present for a given vertex, add that vertex to the new community
-            if max_gain > 0:            
-                current_community.remove(v_x)
-                new_community.append(v_x)
-            
-            # Remove the empty community
-            if len(current_community) == 0 :
-                communities.remove(current_community)                            
-        i += 1
+                # If maximum gain is present for a given vertex, add that vertex to the new community
+                if max_gain > 0:            
+                    store.move(v_x, new_index)
+                    moved.append(v_x)
+
+        previous, modularity = modularity, composite_modularity(g, alpha, store, sparse)
+        sweep_gain = modularity - previous
+
+        sweeps.append({'visited': len(worklist), 'moves': len(moved), 'gain': float(sweep_gain),
+                       'seconds': time.perf_counter() - start})
+
+        if parallel:
+            sweeps[-1]['conflicts'] = conflicts
+
+        if sweep_gain <= threshold:
+            break
+
+        # Only the moved vertices and their neighbours can have a better community now
+        worklist = sorted(set(moved).union(*([neighbour for neighbour, _ in adjacency[v]] for v in moved)))
         
-    return communities
+    return store.communities(), sweeps
+
+
+def report_sweeps(phase, sweeps):
+    """ This function prints the number of sweeps phase1 took and the statistics of every sweep """
+
+    print("Sweeps for {}: {} in {:.3f}s".format(phase, len(sweeps), sum(sweep['seconds'] for sweep in sweeps)))
+    for i, sweep in enumerate(sweeps):
+        conflicts = ", {} conflicts".format(sweep['conflicts']) if 'conflicts' in sweep else ""
+        print("    Sweep {}: {} vertices visited, {} moves{}, gain {:.6f}, {:.3f}s".format(
+            i + 1, sweep['visited'], sweep['moves'], conflicts, sweep['gain'], sweep['seconds']))
 
-def phase2(g, alpha, communities):
-    """ This function emulates the phase 2 of the SAC1 Algorithm from the reference.
+def phase2(g, attribute_values, communities):
+    """ This function emulates the phase 2 of the SAC1 Algorithm from the reference: every community becomes
+        one vertex of a new graph. It is built directly from array sums: the weight of the edge between two
+        communities is the total weight of the edges between their members, the edges inside a community
+        become a loop and the attributes of a community are the mean attributes of its members.
+        Returns the new graph and its attribute matrix.
         Reference: Section 4 A from Community Detection based on Structural and Attribute Similarities paper """
     
     # Get a mapping of vertex-community
-    vertex_map = get_vertex_to_community_map(g, communities)
-  
-    # Contract vertices. Here each community will be considered a new node
-    g.contract_vertices(vertex_map, combine_attrs = "mean")
-    
-    # Combine the egdes
-    g.simplify(combine_edges = sum)        
+    vertex_map = np.array(get_vertex_to_community_map(g, communities))
+    k = len(communities)
+
+    edges = np.array(g.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+    weights = np.array(g.es['weight'] if 'weight' in g.es.attributes() else np.ones(len(edges)), dtype=np.float64)
+
+    # Combine the edges between every pair of communities
+    source, target = vertex_map[edges[:, 0]], vertex_map[edges[:, 1]]
+    pairs, combined = np.unique(np.minimum(source, target) * k + np.maximum(source, target), return_inverse=True)
+
+    contracted = Graph(n=k, edges=np.column_stack([pairs // k, pairs % k]).tolist())
+    contracted.es['weight'] = np.bincount(combined.ravel(), weights=weights, minlength=len(pairs)).tolist()
+
+    # Average the attributes of the members
+    attribute_sums = np.zeros((k, attribute_values.shape[1]))
+    np.add.at(attribute_sums, vertex_map, attribute_values)
     
-    return g
+    return contracted, attribute_sums/np.bincount(vertex_map, minlength=k)[:, None]
+
+
+def group_vertices(membership, k):
+    """ This function lists the vertices of each of the k communities of the membership in one pass:
+        a stable sort keeps the vertices of a community in increasing order """
+
+    order = np.argsort(membership, kind='stable')
+
+    return [vertices.tolist() for vertices in np.split(order, np.cumsum(np.bincount(membership, minlength=k))[:-1])]
+
+
+def multilevel(g, attribute_values, alpha, sparse=False, prepared=False, parallel=False, max_sweeps=15,
+               threshold=0.0):
+    """ This function runs the SAC1 Algorithm level by level: phase1 on the graph, phase2 to contract its
+        communities, phase1 on the contracted graph and so on, as long as the modularity of the communities
+        on g improves and phase1 still merges vertices.
+        parallel, max_sweeps and threshold are passed on to phase1. If prepared, prepare_attribute_similarity has
+        already been called for g; what it prepared is left as it is and in place again on return, so that it can
+        be reused for other alphas.
+        Returns the dendrogram, one dictionary per level with the membership of the vertices of the level's
+        graph, the communities and membership of the vertices of g, their modularity, the phase1 sweeps and the
+        seconds spent preparing the similarities of the level and contracting its communities (phase2).
+        Reference: Section 4 A from Community Detection based on Structural and Attribute Similarities paper """
+
+    global similarity_matrix, attributes
+    prepared_similarity = similarity_matrix, attributes
+
+    levels = []
+    level_graph = g
+    membership = np.arange(g.vcount())
+
+    while True:
+
+        start = time.perf_counter()
+        if levels or not prepared:
+            prepare_attribute_similarity(attribute_values, sparse)
+        similarity_seconds = time.perf_counter() - start
+
+        communities, sweeps = phase1(level_graph, alpha, [[v] for v in range(level_graph.vcount())], sparse,
+                                     max_sweeps, threshold, parallel)
+        level_membership = np.array(get_vertex_to_community_map(level_graph, communities))
+
+        # Communities of the vertices of g
+        membership = level_membership[membership]
+        modularity = g.modularity(membership.tolist())
+
+        if levels and modularity <= levels[-1]['modularity']:
+            break
+
+        levels.append({
+            'level_membership': level_membership,
+            'membership': membership,
+            'communities': group_vertices(membership, len(communities)),
+            'modularity': modularity,
+            'sweeps': sweeps,
+            'similarity_seconds': similarity_seconds,
+            'contraction_seconds': 0.0
+        })
+
+        if len(communities) == level_graph.vcount():
+            break
+
+        start = time.perf_counter()
+        level_graph, attribute_values = phase2(level_graph, attribute_values, communities)
+        levels[-1]['contraction_seconds'] = time.perf_counter() - start
+
+    similarity_matrix, attributes = prepared_similarity
+
+    return levels
+
+
+def init_sweep_worker(g, attribute_values, prepared_similarity, sparse, parallel, max_sweeps, threshold):
+    """ This function stores the read-only inputs of an alpha sweep in a worker process """
+
+    global sweep_state, similarity_matrix, attributes
+    sweep_state = (g, attribute_values, sparse, parallel, max_sweeps, threshold)
+    similarity_matrix, attributes = prepared_similarity
+
+
+def run_alpha(alpha):
+    """ This function runs the SAC1 Algorithm for one alpha of a sweep and returns its dendrogram """
+
+    g, attribute_values, sparse, parallel, max_sweeps, threshold = sweep_state
+
+    return multilevel(g, attribute_values, alpha, sparse, prepared=True, parallel=parallel, max_sweeps=max_sweeps,
+                      threshold=threshold)
+
+
+def sweep(g, attribute_values, alphas, sparse=False, workers=1, parallel=False, max_sweeps=15, threshold=0.0):
+    """ This function runs the SAC1 Algorithm for every alpha and returns their dendrograms in the same order.
+        Neither the graph nor the similarities of its vertices depend on alpha, so they are prepared once and
+        shared read-only by the worker processes; the seconds this took are the similarity_seconds of the first
+        level of every dendrogram """
+
+    start = time.perf_counter()
+    prepare_attribute_similarity(attribute_values, sparse)
+    similarity_seconds = time.perf_counter() - start
+
+    state = (g, attribute_values, (similarity_matrix, attributes), sparse, parallel, max_sweeps, threshold)
+
+    if workers == 1:
+        init_sweep_worker(*state)
+        dendrograms = [run_alpha(alpha) for alpha in alphas]
+
+    else:
+        with multiprocessing.Pool(workers, initializer=init_sweep_worker, initargs=state) as pool:
+            dendrograms = pool.map(run_alpha, alphas, chunksize=1)
+
+    for levels in dendrograms:
+        levels[0]['similarity_seconds'] = similarity_seconds
+
+    return dendrograms
 
 
 def output(communities, alpha):
-    """ This function writes the communities into the file according to alpha values """
+    """ This function writes the communities into the file according to alpha values.
+        Alphas other than 0, 0.5 and 1 keep their value in the file name """
     
     a = 0    
     if alpha == 0:
         a = 0
     elif alpha == 0.5:
         a = 5
-    else:
+    elif alpha == 1:
         a = 1
+    else:
+        a = alpha
         
     file = open("communities_" + str(a) + ".txt", 'w+')
     for community in communities:
@@ -186,76 +652,57 @@ def output(communities, alpha):
     file.close()
 
 
-def main(alpha):
-    """ This is where the action happens """
-    
-    g = Graph()
-
-   
-    # Add vertices
-    dataset = pd.read_csv('data/fb_caltech_small_attrlist.csv')
+def main(alphas, sparse=False, workers=1, parallel=False, attribute_path='data/fb_caltech_small_attrlist.csv',
+         edge_path='data/fb_caltech_small_edgelist.txt', cache_dir='.sac1_cache', max_sweeps=15, threshold=0.0):
+    """ This is where the action happens.
+        Every alpha gets its own communities file; with several alphas they are run by the given number of
+        worker processes. With sparse the V x V similarity matrix is never allocated, see
+        compute_community_attribute_sums, with parallel phase1 moves batches of vertices, see parallel_sweep.
+        phase1 stops after max_sweeps sweeps or a sweep that raises the composite modularity by no more than
+        threshold """
     
-    V = len(dataset)
+    g, attribute_values = load_graph(attribute_path, edge_path, cache_dir)
     
-    g.add_vertices(V)
     
-    for attribute in dataset.columns.tolist():
-        g.vs[attribute] = dataset[attribute]
+    # Phase 1 and Phase 2 on every level of the hierarchy, for every alpha
+    dendrograms = sweep(g, attribute_values, alphas, sparse, workers, parallel, max_sweeps, threshold)
 
-        
-    # Add edges
-    with open('data/fb_caltech_small_edgelist.txt') as f:
-        edges = [tuple(x.split()) for x in f.readlines()]
-    
-    edges = [(int(edge[0]), int(edge[1])) for edge in edges]
-    
-    g.add_edges(edges)
-    
+    for alpha, levels in zip(alphas, dendrograms):
+        print("Alpha: {}".format(alpha))
 
-    
-    # Similarity Matrix
-    global similarity_matrix
-    similarity_matrix = np.zeros((V,V))
-    
-    
-    # Phase 1
-    communities = [[int(x)] for x in range(V)]
-    compute_similarity_matrix(g)
-    
-    C1 = phase1(g, alpha, communities)
-    print("Community Count for Phase 1: {}".format(len(C1)))
-    
-    P1_mod = g.modularity(get_vertex_to_community_map(g, C1))
-    print("Modularity for Phase 1: {}".format(P1_mod))
-    
-    
-    # Phase 2
-    g = phase2(g, alpha, C1)
-    
-    communities = [[int(x)] for x in range(g.vcount())]
-    compute_similarity_matrix(g)
-  
-    
-    # Reapplying phase 1
-    C2 = phase1(g, alpha, communities)    
-    print("Community Count for Phase 2: {}".format(len(C2)))
-    
-    P2_mod = g.modularity(get_vertex_to_community_map(g, C2))
-    print("Modularity for Phase 2: {}".format(P2_mod))
-    
-    
-    # Write the communities to the file    
-    if (P1_mod > P2_mod):
-        output(C1, alpha)
-        print ('Phase 1 communities have been written as they have a high modularity')
+        for i, level in enumerate(levels):
+            report_sweeps("Level {}".format(i + 1), level['sweeps'])
+            print("Community Count for Level {}: {}".format(i + 1, len(level['communities'])))
+            print("Modularity for Level {}: {}".format(i + 1, level['modularity']))
+            print("Similarity and Contraction Time for Level {}: {:.3f}s, {:.3f}s".format(
+                i + 1, level['similarity_seconds'], level['contraction_seconds']))
         
-    else:
-        output(C2, alpha)
-        print ('Phase 2 communities have been written as they have a high modularity')
+        
+        # Write the communities to the file    
+        output(levels[-1]['communities'], alpha)
+        print ('Level {} communities have been written as they have the highest modularity'.format(len(levels)))
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print ("INVALID! Please enter the alpha value")
-    else:
-        main(float(sys.argv[1]))
+
+    parser = argparse.ArgumentParser(description="Attributed community detection with the SAC1 Algorithm")
+    parser.add_argument('alphas', type=float, nargs='+', help="weight of the structural modularity, one run each")
+    parser.add_argument('--sparse', action='store_true', help="never allocate the V x V similarity matrix")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of processes running the alphas, 0 for one per core")
+    parser.add_argument('--parallel', action='store_true', help="evaluate the moves of phase1 in batches of vertices")
+    parser.add_argument('--attributes', default='data/fb_caltech_small_attrlist.csv', help="attribute list CSV")
+    parser.add_argument('--edges', default='data/fb_caltech_small_edgelist.txt', help="edge list, one pair per line")
+    parser.add_argument('--cache-dir', default='.sac1_cache', help="folder of the parsed graph cache, '' for none")
+    parser.add_argument('--max-sweeps', type=int, default=15, help="maximum number of phase1 sweeps per level")
+    parser.add_argument('--threshold', type=float, default=0.0,
+                        help="stop phase1 after a sweep that raises the composite modularity by no more than this")
+
+    args = parser.parse_args()
+    if args.max_sweeps < 1:
+        parser.error("--max-sweeps must be at least 1")
+    if args.workers < 0:
+        parser.error("--workers must not be negative")
+
+    main(args.alphas, args.sparse, args.workers or os.cpu_count(), args.parallel, args.attributes, args.edges,
+         args.cache_dir, args.max_sweeps, args.threshold)